@@ -0,0 +1,65 @@
+"""
+Decode a synthetic core/get response as Itop.request did before the codec layer and as it does now.
+
+    python -m benchmarks.codec --objects 10000
+"""
+import json
+import time
+
+from itoptop import codec
+
+
+def payload(objects=10000, fields=40):
+    """
+    core/get response body with objects of fields string attributes and the '*+' friendlyname extras.
+    :return: bytes
+    """
+    result = {}
+    for i in range(1, objects + 1):
+        obj_fields = {'f%d' % j: 'value %d of object %d' % (j, i) for j in range(fields)}
+        obj_fields.update({
+            'name': 'Object %d' % i,
+            'org_id': str(i % 50),
+            'org_id_friendlyname': 'Organization %d' % (i % 50),
+            'org_id_obsolescence_flag': 'no',
+            'friendlyname': 'Object %d' % i
+        })
+        result['Server::%d' % i] = {'code': 0, 'message': '', 'class': 'Server', 'key': str(i), 'fields': obj_fields}
+    return json.dumps({'objects': result, 'code': 0, 'message': 'Found: %d' % objects}).encode('utf-8')
+
+
+def legacy(content):
+    json_return = json.loads(content.decode('utf-8'))
+    clean_objects = list(json_return['objects'].values()) if 'objects' in json_return else []
+    return [{**obj['fields'], **{'id': obj['key']}} for obj in clean_objects]
+
+
+def current(content):
+    return codec.clean_objects(codec.loads(content)['objects'])
+
+
+def best(fn, content, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(content)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(objects=10000, fields=40, repeat=5):
+    content = payload(objects, fields)
+    print('payload: %d objects, %.1f MB, codec backend: %s' % (objects, len(content) / 2 ** 20, codec.backend))
+    assert legacy(content) == current(content)
+    for name, fn in (('legacy', legacy), ('codec', current)):
+        print('%-8s %8.1f ms' % (name, best(fn, content, repeat) * 1000))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, default=10000)
+    parser.add_argument('--fields', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.objects, args.fields, args.repeat)
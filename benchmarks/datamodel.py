@@ -0,0 +1,95 @@
+"""
+Compare load time and lookup latency of the compiled DataModel against the former XPath implementation.
+
+    python -m benchmarks.datamodel --classes 2000
+"""
+import os
+import tempfile
+import time
+
+from itoptop.datamodel import DataModel
+
+from .generate import datamodel
+
+
+class XPathDataModel(object):
+    """
+    DataModel as it was before the compiled index: full tree in memory and XPath scans for every lookup.
+    """
+
+    def __init__(self, filename):
+        import re
+        from lxml import etree
+        xml = open(filename, encoding='utf-8', errors='replace').read()
+        xml = re.sub('xmlns(:xsi|)="[^"]+"', '', xml, count=1)
+        xml = re.sub('xsi:', '', xml, count=0)
+        xml = bytes(bytearray(xml, encoding='utf-8'))
+        self.root = etree.XML(xml)
+        schemas = [node for node in self.root.xpath("//class") if 'id' in node.attrib]
+        self.schemas = [schema.attrib['id'] for schema in schemas]
+
+    def lookupExternalField(self, schema):
+        root = self.root
+        schema_lookups = {}
+        fields = list(set(root.xpath("//class[@id='%s']//field[@type='AttributeExternalField']/@id" % schema)))
+        for field in fields:
+            key = root.xpath("//class[@id='%s']//field[@id='%s']/extkey_attcode/text()" % (schema, field))[0]
+            lookup_field = root.xpath("//class[@id='%s']//field[@id='%s']/target_attcode/text()" % (schema, field))[0]
+            current_schema = schema
+            while current_schema:
+                if not root.xpath("//class[@id='%s']//field[@id='%s']/@type" % (current_schema, key)):
+                    parent = root.xpath("//class[@id='%s']/parent/text()" % current_schema)
+                    current_schema = parent[0] if parent else None
+                else:
+                    key_type = root.xpath("//class[@id='%s']//field[@id='%s']/@type" % (current_schema, key))[0]
+                    if key_type == 'AttributeHierarchicalKey':
+                        lookup_schema = current_schema
+                    else:
+                        lookup_schema = root.xpath(
+                            "//class[@id='%s']//field[@id='%s']/target_class/text()" % (current_schema, key))[0]
+                    schema_lookups[field] = (key, lookup_schema, lookup_field)
+                    break
+
+        parent = root.xpath("//class[@id='%s']/parent/text()" % schema)
+        if parent and parent[0] != 'cmdbAbstractObject':
+            lookups_inheritance = dict(self.lookupExternalField(parent[0]))
+            lookups_inheritance.update(schema_lookups)
+            schema_lookups = lookups_inheritance
+        return schema_lookups
+
+
+def measure(cls, filename, schemas):
+    start = time.perf_counter()
+    model = cls(filename)
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lookups = [model.lookupExternalField(schema) for schema in schemas]
+    lookup = (time.perf_counter() - start) / len(schemas)
+    return model, load, lookup, lookups
+
+
+def main(classes=500, fields=30, samples=50):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'datamodel.xml')
+        names = datamodel(filename, classes, fields)
+        schemas = names[-samples:]
+        print('datamodel: %d classes, %.1f MB' % (len(names), os.path.getsize(filename) / 2 ** 20))
+
+        _, load, lookup, compiled = measure(DataModel, filename, schemas)
+        print('%-10s load %8.3f s   first lookup %10.1f us' % ('compiled', load, lookup * 1e6))
+
+        _, load, lookup, legacy = measure(XPathDataModel, filename, schemas)
+        print('%-10s load %8.3f s   first lookup %10.1f us' % ('xpath', load, lookup * 1e6))
+
+        assert compiled == legacy, 'compiled lookups differ from xpath lookups'
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--classes', type=int, default=500)
+    parser.add_argument('--fields', type=int, default=30)
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+    main(args.classes, args.fields, args.samples)
@@ -0,0 +1,83 @@
+"""
+Synthetic iTop datamodel generator.
+
+    python -m benchmarks.generate datamodel.xml --classes 2000
+"""
+import random
+
+
+def datamodel(filename, classes=500, fields=30, seed=0):
+    """
+    Write a datamodel xml with the same structure of itop data/datamodel-production.xml.
+    Every class has string fields, external keys with their external fields and a linked set.
+    :param filename: output xml
+    :param classes: number of classes
+    :param fields: number of string fields per class
+    :param seed: random seed
+    :return: list of class ids
+    """
+    rnd = random.Random(seed)
+    names = ['Organization'] + ['Class%d' % i for i in range(1, classes)]
+    links = []
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<itop_design xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="1.6">\n<classes>\n')
+
+        for i, name in enumerate(names):
+            parent = names[rnd.randrange(i)] if i > 1 and rnd.random() < 0.3 else 'cmdbAbstractObject'
+            f.write('<class id="%s" _created_in="itop-structure">\n<parent>%s</parent>\n' % (name, parent))
+            f.write('<properties><category>bizmodel,searchable</category><db_table>%s</db_table></properties>\n'
+                    % name.lower())
+            f.write('<fields>\n')
+            f.write('<field id="name" xsi:type="AttributeString"><sql>name</sql><is_null_allowed>false'
+                    '</is_null_allowed></field>\n')
+            for j in range(fields):
+                f.write('<field id="f%d" xsi:type="AttributeString"><sql>f%d</sql></field>\n' % (j, j))
+            if name == 'Organization':
+                f.write('<field id="parent_id" xsi:type="AttributeHierarchicalKey"><target_class>Organization'
+                        '</target_class><on_target_delete>DEL_MANUAL</on_target_delete></field>\n')
+                f.write('<field id="parent_name" xsi:type="AttributeExternalField"><extkey_attcode>parent_id'
+                        '</extkey_attcode><target_attcode>name</target_attcode></field>\n')
+            else:
+                f.write('<field id="org_id" xsi:type="AttributeExternalKey"><target_class>Organization'
+                        '</target_class></field>\n')
+                f.write('<field id="org_name" xsi:type="AttributeExternalField"><extkey_attcode>org_id'
+                        '</extkey_attcode><target_attcode>name</target_attcode></field>\n')
+                target = names[rnd.randrange(i)]
+                f.write('<field id="ref_id" xsi:type="AttributeExternalKey"><target_class>%s</target_class>'
+                        '</field>\n' % target)
+                f.write('<field id="ref_name" xsi:type="AttributeExternalField"><extkey_attcode>ref_id'
+                        '</extkey_attcode><target_attcode>name</target_attcode></field>\n')
+                link = 'lnk%sTo%s' % (name, target)
+                links.append((link, name, target))
+                f.write('<field id="refs_list" xsi:type="AttributeLinkedSetIndirect"><linked_class>%s'
+                        '</linked_class><ext_key_to_me>me_id</ext_key_to_me><ext_key_to_remote>remote_id'
+                        '</ext_key_to_remote></field>\n' % link)
+            f.write('</fields>\n')
+            f.write('<methods/><presentation><list><items><item id="name"><rank>10</rank></item></items></list>'
+                    '</presentation>\n</class>\n')
+
+        for link, me, remote in links:
+            f.write('<class id="%s" _created_in="itop-structure">\n<parent>cmdbAbstractObject</parent>\n<fields>\n'
+                    % link)
+            for key, target in (('me_id', me), ('remote_id', remote)):
+                f.write('<field id="%s" xsi:type="AttributeExternalKey"><target_class>%s</target_class></field>\n'
+                        % (key, target))
+                f.write('<field id="%s" xsi:type="AttributeExternalField"><extkey_attcode>%s</extkey_attcode>'
+                        '<target_attcode>name</target_attcode></field>\n' % (key.replace('_id', '_name'), key))
+            f.write('</fields>\n</class>\n')
+
+        f.write('</classes>\n</itop_design>\n')
+
+    return names + [link for link, _, _ in links]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filename')
+    parser.add_argument('--classes', type=int, default=500)
+    parser.add_argument('--fields', type=int, default=30)
+    args = parser.parse_args()
+    datamodel(args.filename, args.classes, args.fields)
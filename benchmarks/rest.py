@@ -0,0 +1,186 @@
+"""
+Reproducible scenarios of the client against the mock iTop server, each run in its own process.
+
+    python -m benchmarks.rest
+    python -m benchmarks.rest --scenario insert --rows 10000 --latency 0.002 --workers 20
+
+Scenarios:
+    insert      insert rows in Class1 with two lookups each (org_name, ref_name)
+    sync        sync rows over as many existing ones, 1% changed, with sync(diff=True)
+    export      read rows with iter_find, page by page
+    datamodel   load a synthetic datamodel xml and look up external fields and linked sets of every class
+
+Reported: elapsed seconds, HTTP requests per second, p50/p99 request latency seen by the client, peak RSS of the
+process and its growth during the scenario (the mock server store is allocated before).
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from itoptop import Itop
+from itoptop.datamodel import DataModel
+
+from .generate import datamodel
+from .server import MockItop
+
+SCENARIOS = ('insert', 'sync', 'export', 'datamodel')
+DEFAULT_ROWS = {'insert': 10000, 'sync': 100000, 'export': 100000, 'datamodel': 2000}
+ORGANIZATIONS = 100
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of the process in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def row(i, changed=False):
+    return {
+        'name': 'Item %d' % i,
+        'f0': 'value %d%s' % (i, ' changed' if changed else ''),
+        'f1': 'constant',
+        'org_name': 'Org %d' % (i % ORGANIZATIONS),
+        'ref_name': 'Org %d' % ((i + 1) % ORGANIZATIONS)
+    }
+
+
+class Context(object):
+    def __init__(self, tmp, latency=0.0, error_rate=0.0, workers=10):
+        """
+        Mock server with organizations loaded, and a client timing every HTTP request.
+        """
+        filename = os.path.join(tmp, 'datamodel.xml')
+        datamodel(filename, classes=50, fields=5)
+        self.data_model = DataModel(filename, cache=False)
+        self.mock = MockItop(self.data_model, latency=latency, error_rate=error_rate).start()
+        self.organizations = self.mock.store.load('Organization', [
+            {'name': 'Org %d' % i} for i in range(ORGANIZATIONS)])
+        self.workers = workers
+        self.itop = Itop(self.mock.url, '1.3', 'admin', 'admin', self.data_model, pool_size=workers,
+                         check_credentials=False)
+        self.latencies = []
+
+        post = self.itop.transport.post
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return post(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+        self.itop.transport.post = timed
+
+    def load(self, rows):
+        organization = lambda i: self.organizations[i % ORGANIZATIONS]
+        self.mock.store.load('Class1', [
+            {'name': 'Item %d' % i, 'f0': 'value %d' % i, 'f1': 'constant', 'org_id': organization(i),
+             'ref_id': organization(i + 1)} for i in range(rows)])
+
+    def close(self):
+        self.itop.close()
+        self.mock.stop()
+
+
+def insert(context, rows):
+    context.itop.Class1.insert([row(i) for i in range(rows)], workers=context.workers)
+    assert len(context.mock.store.objects['Class1']) == rows
+
+
+def sync(context, rows):
+    objs = [row(i, changed=(i % 100 == 0)) for i in range(rows)]
+    result = context.itop.Class1.sync(objs, keys=['name'], workers=context.workers, diff=True)
+    assert (result['created'], result['updated']) == (0, len(range(0, rows, 100))), result
+
+
+def export(context, rows):
+    count = sum(1 for _ in context.itop.Class1.iter_find({}, ['name', 'f0', 'org_name'], page_size=1000))
+    assert count == rows
+
+
+def run(scenario, rows=None, latency=0.0, error_rate=0.0, workers=10):
+    """
+    Run a scenario in this process.
+    :return: dict of measures
+    """
+    rows = rows or DEFAULT_ROWS[scenario]
+    with tempfile.TemporaryDirectory() as tmp:
+        if scenario == 'datamodel':
+            filename = os.path.join(tmp, 'datamodel.xml')
+            datamodel(filename, classes=rows)
+            baseline = peak_rss()
+            start = time.perf_counter()
+            data_model = DataModel(filename, cache=False)
+            for schema in data_model.schemas:
+                data_model.lookupExternalField(schema)
+                data_model.lookupLinkedSet(schema)
+            seconds = time.perf_counter() - start
+            return {'scenario': scenario, 'rows': rows, 'seconds': seconds, 'requests': 0, 'rps': 0.0,
+                    'p50': 0.0, 'p99': 0.0, 'rss': peak_rss(), 'rss_growth': peak_rss() - baseline}
+
+        context = Context(tmp, latency, error_rate, workers)
+        try:
+            if scenario in ('sync', 'export'):
+                context.load(rows)
+            baseline = peak_rss()
+            start = time.perf_counter()
+            globals()[scenario](context, rows)
+            seconds = time.perf_counter() - start
+        finally:
+            context.close()
+
+        latencies = context.latencies
+        return {
+            'scenario': scenario, 'rows': rows, 'seconds': seconds, 'requests': len(latencies),
+            'rps': len(latencies) / seconds if seconds else 0.0,
+            'p50': percentile(latencies, 0.5) * 1000, 'p99': percentile(latencies, 0.99) * 1000,
+            'rss': peak_rss(), 'rss_growth': peak_rss() - baseline
+        }
+
+
+def main(scenarios=SCENARIOS, rows=None, latency=0.0, error_rate=0.0, workers=10):
+    print('%-10s %8s %9s %9s %9s %9s %9s %10s %10s' % (
+        'scenario', 'rows', 'seconds', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'RSS MB', '+RSS MB'))
+    for scenario in scenarios:
+        # a process per scenario, so peak RSS is not inherited from the previous one
+        command = [sys.executable, '-m', 'benchmarks.rest', '--scenario', scenario, '--json',
+                   '--latency', str(latency), '--error-rate', str(error_rate), '--workers', str(workers)]
+        if rows:
+            command += ['--rows', str(rows)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print('%-10s %8d %9.2f %9d %9.0f %9.2f %9.2f %10.1f %10.1f' % (
+            scenario, result['rows'], result['seconds'], result['requests'], result['rps'], result['p50'],
+            result['p99'], result['rss'], result['rss_growth']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='scenario to run, may be repeated. default is every scenario')
+    parser.add_argument('--rows', type=int, help='rows of the scenario, classes for datamodel')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added by the server to each request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with HTTP 503, retried by parallel updates '
+                             '(creates are not retried, see is_transient)')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='run a single scenario here and print its result')
+    args = parser.parse_args()
+    if args.json:
+        print(json.dumps(run(args.scenario[0], args.rows, args.latency, args.error_rate, args.workers)))
+    else:
+        main(args.scenario or SCENARIOS, args.rows, args.latency, args.error_rate, args.workers)
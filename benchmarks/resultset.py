@@ -0,0 +1,63 @@
+"""
+Memory of a synthetic '*+' core/get result kept as a list of dicts and as a ResultSet.
+
+    python -m benchmarks.resultset --objects 100000
+"""
+import time
+import tracemalloc
+
+from itoptop import ResultSet, codec
+
+
+def payload(count=100000, fields=40):
+    """
+    Objects shaped like '*+' output: a unique id and name, a few external keys with their friendly names, and
+    attributes that are mostly empty or take a few values (status, enums, flags).
+    :return: json bytes of the list of objects
+    """
+    output = []
+    for i in range(1, count + 1):
+        obj = {'f%d' % j: ['', 'no', 'yes', 'value %d' % (i % (j + 2))][j % 4] for j in range(fields)}
+        obj.update({
+            'id': str(i),
+            'name': 'Object %d' % i,
+            'status': ('production', 'implementation', 'stock', 'obsolete')[i % 4],
+            'org_id': str(i % 50),
+            'org_id_friendlyname': 'Organization %d' % (i % 50),
+            'location_id': str(i % 300),
+            'location_id_friendlyname': 'Site %d' % (i % 300),
+            'friendlyname': 'Object %d' % i
+        })
+        output.append(obj)
+    return codec.dumps(output)
+
+
+def measure(build, content):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = build(codec.loads(content))
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del output
+    return size, seconds
+
+
+def main(count=100000, fields=40):
+    content = payload(count, fields)
+    print('%d objects of %d fields, codec backend: %s' % (count, fields + 8, codec.backend))
+    baseline = None
+    for name, build in (('dicts', list), ('resultset', ResultSet)):
+        size, seconds = measure(build, content)
+        baseline = baseline or size
+        print('%-10s %8.1f MB %6d bytes/object %6.1fx %8.1f s' % (
+            name, size / 2 ** 20, size // count, baseline / size, seconds))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, default=100000)
+    parser.add_argument('--fields', type=int, default=40)
+    args = parser.parse_args()
+    main(args.objects, args.fields)
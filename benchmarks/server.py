@@ -0,0 +1,554 @@
+"""
+In-process stand-in for iTop rest.php, to measure the client without an iTop instance.
+
+    python -m benchmarks.server --port 8080 --latency 0.01 --error-rate 0.01
+
+Objects are kept in memory by class. core/get, core/create, core/update, core/delete, core/get_related,
+core/apply_stimulus and core/check_credentials are emulated, with the OQL generated by itoptop (AND, OR, comparisons,
+LIKE, IN, ISNULL). Writes are recorded as CMDBChangeOp objects, as iTop does.
+"""
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+TOKEN = re.compile(r'\s*(?:(?P<number>-?\d+(?:\.\d+)?)|(?P<string>"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|'
+                   r'(?P<op>!=|>=|<=|=|>|<|\(|\)|,)|(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:->[A-Za-z_][A-Za-z0-9_]*)*))')
+
+
+def tokenize(text):
+    tokens, pos = [], 0
+    text = text.strip()
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if not match:
+            raise ValueError('OQL syntax error at %d: %s' % (pos, text))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'name' and value.upper() in ('SELECT', 'WHERE', 'AND', 'OR', 'NOT', 'LIKE', 'IN', 'ISNULL'):
+            kind, value = 'keyword', value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser(object):
+    """
+    OQL to a tree of tuples: ('or', [...]), ('and', [...]), ('cmp', op, left, right), ('like', negate, left, right),
+    ('in', negate, left, values, normalized values), ('isnull', negate, field).
+    Operands are ('field', name) or ('value', value).
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        pos = self.pos + offset
+        return self.tokens[pos] if pos < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if (kind and token[0] != kind) or (value is not None and token[1] != value):
+            raise ValueError('OQL syntax error, expected %s got %r' % (value or kind, token[1]))
+        self.pos += 1
+        return token[1]
+
+    def select(self):
+        self.take('keyword', 'SELECT')
+        schema = self.take('name')
+        where = None
+        if self.peek() == ('keyword', 'WHERE'):
+            self.take()
+            where = self.expression()
+        if self.peek()[0] is not None:
+            raise ValueError('OQL syntax error, unexpected %r' % (self.peek()[1],))
+        return schema, where
+
+    def expression(self):
+        terms = [self.conjunction()]
+        while self.peek() == ('keyword', 'OR'):
+            self.take()
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else ('or', terms)
+
+    def conjunction(self):
+        terms = [self.term()]
+        while self.peek() == ('keyword', 'AND'):
+            self.take()
+            terms.append(self.term())
+        return terms[0] if len(terms) == 1 else ('and', terms)
+
+    def operand(self):
+        kind, value = self.peek()
+        self.pos += 1
+        if kind == 'name':
+            return 'field', value
+        if kind in ('string', 'number'):
+            return 'value', value
+        raise ValueError('OQL syntax error, unexpected %r' % (value,))
+
+    def term(self):
+        negate = False
+        if self.peek() == ('keyword', 'NOT'):
+            self.take()
+            negate = True
+        if self.peek() == ('keyword', 'ISNULL'):
+            self.take()
+            self.take('op', '(')
+            field = self.take('name')
+            self.take('op', ')')
+            return 'isnull', negate, field
+        if self.peek() == ('op', '('):
+            self.take()
+            inner = self.expression()
+            self.take('op', ')')
+            return ('not', inner) if negate else inner
+
+        left = self.operand()
+        if self.peek() == ('keyword', 'NOT'):
+            self.take()
+            negate = True
+        kind, value = self.peek()
+        if (kind, value) == ('keyword', 'LIKE'):
+            self.take()
+            return 'like', negate, left, self.operand()
+        if (kind, value) == ('keyword', 'IN'):
+            self.take()
+            self.take('op', '(')
+            values = [self.operand()[1]]
+            while self.peek() == ('op', ','):
+                self.take()
+                values.append(self.operand()[1])
+            self.take('op', ')')
+            return 'in', negate, left, values, frozenset(text(v) for v in values)
+        return 'cmp', self.take('op'), left, self.operand()
+
+
+def text(value):
+    """
+    MySQL default collation: comparisons ignore case, numbers and numeric strings are equal.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).lower()
+
+
+def compare(op, left, right):
+    try:
+        left_number, right_number = float(left), float(right)
+        left, right = left_number, right_number
+    except (TypeError, ValueError):
+        left, right = text(left), text(right)
+    return {
+        '=': left == right, '!=': left != right, '>': left > right,
+        '>=': left >= right, '<': left < right, '<=': left <= right
+    }[op]
+
+
+def evaluate(node, obj):
+    kind = node[0]
+    if kind == 'or':
+        return any(evaluate(child, obj) for child in node[1])
+    if kind == 'and':
+        return all(evaluate(child, obj) for child in node[1])
+    if kind == 'not':
+        return not evaluate(node[1], obj)
+    if kind == 'isnull':
+        value = obj.get(node[2])
+        return (value in (None, '', 0, '0')) != node[1]
+
+    def operand(item):
+        return obj.get(item[1]) if item[0] == 'field' else item[1]
+
+    if kind == 'cmp':
+        return compare(node[1], operand(node[2]), operand(node[3]))
+    if kind == 'like':
+        pattern = re.escape(text(operand(node[3]))).replace('%', '.*').replace('_', '.')
+        return bool(re.fullmatch(pattern, text(operand(node[2])), re.S)) != node[1]
+    if kind == 'in':
+        return (text(operand(node[2])) in node[4]) != node[1]
+    raise ValueError('Unknown OQL node %r' % (kind,))
+
+
+class Store(object):
+    def __init__(self, data_model=None):
+        """
+        Objects by class, with the relations of the datamodel when given.
+        :param data_model: Optional. itoptop DataModel, for class inheritance and external fields.
+        """
+        self.data_model = data_model
+        self.objects = {}  # class = {id: fields}
+        self.next_ids = {}  # root class = next id
+        self.indexes = {}  # (class, field) = {value: set of ids}
+        self.lock = threading.RLock()
+
+    def root(self, schema):
+        if not self.data_model:
+            return schema
+        ancestors = [schema] + self.data_model.ancestors(schema)
+        return [name for name in ancestors if name != 'cmdbAbstractObject'][-1]
+
+    def classes(self, schema):
+        return [schema] + (self.data_model.subclasses(schema) if self.data_model else [])
+
+    def load(self, schema, objs):
+        """
+        Add objects without history, to prepare a scenario.
+        :return: list of ids
+        """
+        return [self.create(schema, obj, history=False) for obj in objs]
+
+    def create(self, schema, fields, history=True):
+        with self.lock:
+            root = self.root(schema)
+            key = self.next_ids.get(root, 1)
+            self.next_ids[root] = key + 1
+            self.objects.setdefault(schema, {})[str(key)] = dict(fields)
+            self.touch(schema)
+            if history:
+                self.change(schema, key, 'CMDBChangeOpCreate')
+            return str(key)
+
+    def update(self, schema, key, fields):
+        with self.lock:
+            self.objects[schema][key].update(fields)
+            self.touch(schema)
+            self.change(schema, key, 'CMDBChangeOpSetAttributeScalar')
+
+    def delete(self, schema, key):
+        with self.lock:
+            del self.objects[schema][key]
+            self.touch(schema)
+            self.change(schema, key, 'CMDBChangeOpDelete')
+
+    def change(self, schema, key, finalclass):
+        self.create('CMDBChangeOp', {'objclass': schema, 'objkey': str(key), 'finalclass': finalclass,
+                                     'date': time.strftime('%Y-%m-%d %H:%M:%S')}, history=False)
+
+    def touch(self, schema):
+        for index in [index for index in self.indexes if index[0] == schema]:
+            del self.indexes[index]
+
+    def index(self, schema, field):
+        index = self.indexes.get((schema, field))
+        if index is None:
+            index = self.indexes[(schema, field)] = {}
+            for key, fields in self.objects.get(schema, {}).items():
+                index.setdefault(text(key if field == 'id' else fields.get(field)), set()).add(key)
+        return index
+
+    def candidates(self, schema, where):
+        """
+        Ids of schema that may match, using an index on a top level = or IN condition.
+        """
+        terms = where[1] if where and where[0] == 'and' else [where] if where else []
+        for term in terms:
+            if term[0] == 'cmp' and term[1] == '=' and term[2][0] == 'field' and term[3][0] == 'value':
+                values = [term[3][1]]
+            elif term[0] == 'in' and not term[1] and term[2][0] == 'field':
+                values = term[3]
+            else:
+                continue
+            index = self.index(schema, term[2][1])
+            keys = set()
+            for value in values:
+                keys.update(index.get(text(value), ()))
+            return sorted(keys, key=int)
+        return list(self.objects.get(schema, {}))
+
+    def select(self, schema, key):
+        """
+        :param key: id, OQL or dict of fields, as core/get key
+        :return: list of (class, id, fields)
+        """
+        with self.lock:
+            if isinstance(key, dict):
+                key = 'SELECT %s WHERE %s' % (schema, ' AND '.join(
+                    '%s = %s' % (field, json.dumps(value)) for field, value in key.items()) or '1 = 1')
+            if isinstance(key, int) or (isinstance(key, str) and key.strip().isdigit()):
+                key = str(key).strip()
+                return [(name, key, self.objects[name][key]) for name in self.classes(schema)
+                        if key in self.objects.get(name, {})]
+            schema, where = Parser(key).select()
+            output = []
+            for name in self.classes(schema):
+                objects = self.objects.get(name, {})
+                for object_id in self.candidates(name, where):
+                    fields = objects[object_id]
+                    if where is None or evaluate(where, dict(fields, id=object_id)):
+                        output.append((name, object_id, fields))
+            return output
+
+    def output(self, schema, key, fields, output_fields):
+        external = self.data_model.lookupExternalField(schema) if self.data_model else {}
+        if output_fields in (None, '', '*', '*+'):
+            names = list(fields) + list(external) + ['friendlyname', 'finalclass']
+        else:
+            names = [name.strip() for name in output_fields.split(',')]
+        result = {}
+        for name in names:
+            if name in fields:
+                result[name] = fields[name]
+            elif name in external:
+                ext_key, lookup_schema, lookup_field = external[name]
+                target = self.select(lookup_schema, str(fields[ext_key])) if fields.get(ext_key) else []
+                result[name] = target[0][2].get(lookup_field, '') if target else ''
+            elif name == 'friendlyname':
+                result[name] = fields.get('name', '%s::%s' % (schema, key))
+            elif name == 'finalclass':
+                result[name] = schema
+            elif name == 'id':
+                result[name] = key
+            else:
+                result[name] = ''
+        return result
+
+    def related(self, schema, key, relation='impacts', depth=20, direction='down'):
+        """
+        Objects linked by external keys: an object impacts those holding an external key to it.
+        """
+        found = self.select(schema, key)
+        seen = set((self.root(name), object_id) for name, object_id, _ in found)
+        frontier = list(found)
+        downstream = (relation == 'impacts') == (direction == 'down')
+        for _ in range(int(depth)):
+            following = []
+            for name, object_id, fields in frontier:
+                for other in self.neighbours(name, object_id, fields, downstream):
+                    node = (self.root(other[0]), other[1])
+                    if node not in seen:
+                        seen.add(node)
+                        following.append(other)
+            found += following
+            frontier = following
+            if not frontier:
+                break
+        return found
+
+    def neighbours(self, schema, key, fields, downstream):
+        keys = self.external_keys()
+        if downstream:
+            targets = set([schema] + (self.data_model.ancestors(schema) if self.data_model else []))
+            for name, objects in list(self.objects.items()):
+                for field, target in keys.get(name, ()):
+                    if target in targets:
+                        for object_id in self.index(name, field).get(key, ()):
+                            yield name, object_id, objects[object_id]
+        else:
+            for field, target in keys.get(schema, ()):
+                if fields.get(field):
+                    yield from self.select(target, str(fields[field]))
+
+    def external_keys(self):
+        """
+        :return: dict index by class = list of (field, target class), including inherited keys
+        """
+        if not self.data_model:
+            return {}
+        if not hasattr(self, '_external_keys'):
+            self._external_keys = {}
+            for schema in self.data_model.classes:
+                for name in [schema] + self.data_model.ancestors(schema):
+                    for field, properties in self.data_model.fields(name).items():
+                        if properties['type'] == 'AttributeExternalKey' and properties.get('target_class'):
+                            self._external_keys.setdefault(schema, []).append((field, properties['target_class']))
+        return self._external_keys
+
+
+class MockItop(object):
+    def __init__(self, data_model=None, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 auth_user=None, auth_pwd=None, host='127.0.0.1', port=0, seed=0):
+        """
+        Local HTTP server answering iTop REST requests from an in-memory Store.
+        :param data_model: Optional. itoptop DataModel.
+        :param latency: Optional. Seconds added to each response.
+        :param jitter: Optional. Random seconds, up to jitter, added to latency.
+        :param error_rate: Optional. Fraction of requests answered with error_status instead of processed.
+        :param error_status: Optional. HTTP status of injected errors. default is 503.
+        :param auth_user: Optional. If set, requests with other credentials get code 1 (unauthorized).
+        :param auth_pwd: Optional.
+        :param port: Optional. default is a free port.
+        :param seed: Optional. Random seed of latency and errors.
+        """
+        self.store = Store(data_model)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.auth = (auth_user, auth_pwd)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.operations = {}
+        self._lock = threading.Lock()
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                status, content = mock.handle(parse_qs(body.decode('utf-8')))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://%s:%d/webservices/rest.php' % self.server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, form):
+        """
+        :param form: dict of posted form fields, as parse_qs returns
+        :return: (HTTP status, body bytes)
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+            failed = self.error_rate and self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return self.error_status, b'Service Unavailable'
+
+        get = lambda name: form.get(name, [None])[0]
+        if self.auth[0] is not None and (get('auth_user'), get('auth_pwd')) != self.auth:
+            return 200, json.dumps({'code': 1, 'message': 'Error: Invalid login'}).encode('utf-8')
+        try:
+            data = json.loads(get('json_data') or '')
+        except ValueError:
+            return 200, json.dumps({'code': 5, 'message': 'Error: Invalid JSON'}).encode('utf-8')
+
+        operation = data.get('operation')
+        with self._lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+        method = getattr(self, 'op_' + str(operation).replace('core/', ''), None)
+        if method is None:
+            result = {'code': 3, 'message': 'Error: Invalid operation: "%s"' % operation}
+        else:
+            try:
+                with self.store.lock:
+                    result = method(data)
+            except ValueError as e:
+                result = {'code': 100, 'message': 'Error: %s' % e}
+        return 200, json.dumps(result).encode('utf-8')
+
+    def objects(self, found, output_fields, message=''):
+        return {
+            '%s::%s' % (schema, key): {
+                'code': 0, 'message': message, 'class': schema, 'key': key,
+                'fields': self.store.output(schema, key, fields, output_fields)
+            } for schema, key, fields in found
+        }
+
+    def single(self, data):
+        found = self.store.select(data['class'], data['key'])
+        if not found:
+            raise ValueError('No item found with criteria: %s' % data['key'])
+        if len(found) > 1:
+            raise ValueError('Several items found (%d) with criteria: %s' % (len(found), data['key']))
+        return found[0]
+
+    def op_check_credentials(self, data):
+        return {'code': 0, 'message': '', 'authorized': True}
+
+    def op_get(self, data):
+        found = self.store.select(data['class'], data['key'])
+        limit, page = int(data.get('limit') or 0), int(data.get('page') or 1)
+        if limit:
+            found = found[(page - 1) * limit:page * limit]
+        objects = self.objects(found, data.get('output_fields'))
+        return {'objects': objects or None, 'code': 0, 'message': 'Found: %d' % len(found)}
+
+    def op_create(self, data):
+        schema = data['class']
+        key = self.store.create(schema, data.get('fields') or {})
+        found = [(schema, key, self.store.objects[schema][key])]
+        return {'objects': self.objects(found, data.get('output_fields'), 'created'), 'code': 0, 'message': ''}
+
+    def op_update(self, data):
+        schema, key, _ = self.single(data)
+        self.store.update(schema, key, data.get('fields') or {})
+        found = [(schema, key, self.store.objects[schema][key])]
+        return {'objects': self.objects(found, data.get('output_fields'), 'updated'), 'code': 0, 'message': ''}
+
+    def op_apply_stimulus(self, data):
+        schema, key, _ = self.single(data)
+        fields = dict(data.get('fields') or {})
+        fields['last_stimulus'] = data.get('stimulus')
+        self.store.update(schema, key, fields)
+        found = [(schema, key, self.store.objects[schema][key])]
+        return {'objects': self.objects(found, data.get('output_fields'), 'updated'), 'code': 0, 'message': ''}
+
+    def op_delete(self, data):
+        found = self.store.select(data['class'], data['key'])
+        objects = self.objects(found, 'friendlyname', 'Deleted')
+        for schema, key, _ in found:
+            self.store.delete(schema, key)
+        return {'objects': objects or None, 'code': 0, 'message': ''}
+
+    def op_get_related(self, data):
+        found = self.store.related(data['class'], data['key'], data.get('relation', 'impacts'),
+                                   data.get('depth', 20), data.get('direction', 'down'))
+        return {'objects': self.objects(found, 'friendlyname') or None, 'relations': {}, 'code': 0,
+                'message': 'Scope: %d' % len(found)}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--datamodel', help='datamodel xml or precompiled json')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    data_model = None
+    if args.datamodel:
+        from itoptop.datamodel import DataModel
+        data_model = DataModel(args.datamodel)
+    mock = MockItop(data_model, args.latency, args.jitter, args.error_rate, port=args.port)
+    print('Serving %s' % mock.url)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.server.server_close()
@@ -4,3 +4,8 @@ github.com/jonatasrenan/itop_api
 """
 
 from .itop import Itop
+from .aio import AsyncItop
+from .cache import ResponseCache
+from .graph import RelationGraph
+from .changes import Watermarks
+from .resultset import ResultSet
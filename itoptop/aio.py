@@ -0,0 +1,362 @@
+import asyncio
+
+from . import codec
+from .exceptions import ItopError
+from .schema import BaseSchema
+
+
+class AsyncItop(object):
+    url = version = auth_user = auth_pwd = data_model = session = None
+
+    def __init__(self, url, version, auth_user, auth_pwd, data_model=None, concurrency=100):
+        """
+        Create asyncio connection. Use as async context manager or call connect() before requests.
+        :param url: iTop rest.php endpoint
+        :param version: API version
+        :param auth_user: User
+        :param auth_pwd: Password
+        :param data_model: Optional. Path to datamodel xml.
+        :param concurrency: Optional. Maximum number of in-flight requests. default is 100.
+        """
+        self.url = url
+        self.version = version
+        self.auth_user = auth_user
+        self.auth_pwd = auth_pwd
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        if data_model:
+            from .datamodel import DataModel
+            self.data_model = data_model if isinstance(data_model, DataModel) else DataModel(data_model)
+
+    def __getattr__(self, name):
+        """
+        Schemas of the datamodel as attributes, created on first access.
+        """
+        if name.startswith('_') or self.data_model is None or name not in self.data_model.classes:
+            raise AttributeError("'%s' object has no attribute or schema '%s'" % (type(self).__name__, name))
+        schema = AsyncSchema(self, name)
+        self.__dict__[name] = schema
+        return schema
+
+    def __dir__(self):
+        names = list(super(AsyncItop, self).__dir__())
+        if self.data_model:
+            names += self.data_model.schemas
+        return names
+
+    async def connect(self):
+        """
+        Open the HTTP session and check credentials.
+        """
+        import aiohttp
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self.session = aiohttp.ClientSession(connector=connector)
+        data = {
+            'operation': 'core/check_credentials',
+            'user': self.auth_user,
+            'password': self.auth_pwd
+        }
+        await self.request(data)
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, data, raw_response=False):
+        """
+        Generic request to iTop API
+        :param data: Valid Data to iTop
+        :return: Result objects
+        """
+        import aiohttp
+        json_data = codec.dumps(data)
+
+        async with self.semaphore:
+            try:
+                async with self.session.post(
+                    self.url,
+                    data={
+                        'version': self.version,
+                        'auth_user': self.auth_user,
+                        'auth_pwd': self.auth_pwd,
+                        'json_data': json_data
+                    }
+                ) as response:
+                    content = await response.read()
+                    response.raise_for_status()
+            except aiohttp.ClientResponseError as e:
+                raise type(e)(e.request_info, e.history, status=e.status,
+                              message="Could not connect. HTTP code %s. " % e.status + str(e.message))
+            except aiohttp.ClientConnectionError as e:
+                # subclasses such as ClientConnectorError do not take a single message
+                raise aiohttp.ClientConnectionError('Connection refused. ' + str(e)) from e
+
+        try:
+            json_return = codec.loads(content)
+            return_code = json_return['code']
+        except ValueError as e:
+            raise type(e)('Not a valid JSON, maybe the page is returning other data: ' + str(e), "", 0)
+
+        if return_code != 0:
+            raise ItopError(response=response, json_return=json_return)
+
+        if 'objects' not in json_return or json_return['objects'] is None:
+            return []
+
+        if raw_response:
+            return json_return['objects']
+
+        return codec.clean_objects(json_return['objects'])
+
+    def schema(self, name):
+        """
+        Get a specific schema from iTop to manipulate with find, create, update, remove, sync methods.
+        :param name: Schema name
+        :return: AsyncSchema object
+        """
+        return AsyncSchema(self, name)
+
+
+def unwrap(output):
+    if isinstance(output, list) and len(output) == 1:
+        output = output[0]
+
+    if isinstance(output, dict) and len(output) == 1:
+        _, output = list(output.items())[0]
+
+    return output
+
+
+class AsyncSchema(BaseSchema):
+    """
+    Coroutine counterpart of Schema: find, find_related, insert, update, remove, sync, lookup and apply_stimulus.
+    Parallel methods are bounded by AsyncItop concurrency instead of workers.
+    """
+
+    async def find(self, query=None, projection=None, limit='0', page='1'):
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        projection = projection if projection else []
+        if not isinstance(projection, list):
+            raise TypeError("Projection must be a list")
+
+        data = {
+            'operation': 'core/get',
+            'comment': 'Get ' + self.name,
+            'class': self.name,
+            'key': self.to_oql(query),
+            'output_fields': self.to_output_fields(projection),
+            'limit': limit,
+            'page': page
+        }
+
+        response = await self.itop.request(data)
+
+        if projection:
+            output = [{k: v for k, v in obj.items() if k in projection} for obj in response]
+        else:
+            output = response
+
+        return unwrap(output)
+
+    async def find_related(self, query=None, relation='impacts', depth=20, direction='down'):
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        data = {
+            'operation': 'core/get_related',
+            'class': self.name,
+            'key': self.to_oql(query),
+            'relation': relation,
+            'depth': depth,
+            'direction': direction
+        }
+
+        response = await self.itop.request(data, raw_response=True)
+        clean_objects = [{**obj['fields'], **{'id': obj['key']}, **{'class': obj['class']}}
+                         for obj in response.values()] if response else []
+
+        return unwrap(clean_objects)
+
+    async def insert(self, objs):
+        if not (isinstance(objs, dict) or isinstance(objs, list)):
+            raise TypeError("Query must be a object or list of objects")
+        objs = objs if isinstance(objs, list) else [objs]
+
+        objs = [self.clean(obj) for obj in objs]
+
+        if self.itop.data_model:
+            objs = await asyncio.gather(*[self.lookup(obj) for obj in objs])
+
+        datas = [
+            {
+                'operation': 'core/create',
+                'comment': 'Create' + self.name,
+                'class': self.name,
+                'output_fields': "*",
+                'fields': obj
+            } for obj in objs
+        ]
+
+        output = await asyncio.gather(*[self.itop.request(data) for data in datas])
+        return [item for result in output for item in result]
+
+    async def update(self, query, update, upsert=False, multi=False):
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        update = update if update else {}
+        if not isinstance(update, dict):
+            raise TypeError("Query must be a dict")
+
+        key = self.to_oql(query)
+
+        if self.itop.data_model:
+            update = await self.lookup(update)
+
+        update_data = {
+            'operation': 'core/update',
+            'comment': 'Update ' + self.name,
+            'class': self.name,
+            'output_fields': "*",
+            'fields': update,
+            'key': key
+        }
+
+        try:
+            return await self.itop.request(update_data)
+        except ItopError as e:
+            if 'Several items' in str(e):
+                if multi:
+                    objs = await self.itop.request({
+                        'operation': 'core/get',
+                        'class': self.name,
+                        'key': key,
+                        'output_fields': "friendlyname"
+                    })
+                    output = await asyncio.gather(*[
+                        self.itop.request({**update_data, **{'key': obj['id']}}) for obj in objs
+                    ])
+                    return unwrap([item for result in output for item in result])
+                raise e
+
+            if 'No item found for query' in str(e):
+                if upsert:
+                    return await self.insert({**query, **update})
+                return {}
+            raise e
+
+    async def remove(self, query):
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        data = {
+            'operation': 'core/delete',
+            'comment': 'Delete ' + self.name,
+            'class': self.name,
+            'key': self.to_oql(query)
+        }
+        return unwrap(await self.itop.request(data))
+
+    async def sync(self, objs, keys=None):
+        if not keys:
+            keys = ['name']
+
+        if not (isinstance(objs, list)):
+            objs = [objs]
+
+        async def step(obj):
+            query = dict([(field, obj[field]) for field in obj if field in keys])
+            return await self.update(query, obj, upsert=True, multi=False)
+
+        results = await asyncio.gather(*[step(obj) for obj in objs])
+        output = [item for result in results if result for item in result]
+        return unwrap(output)
+
+    async def lookup(self, obj):
+        """
+        Async version of Schema.lookup, resolving every external field of the object concurrently.
+        :param obj:
+        :return:
+        """
+        async def resolve(schema, field, old_value, lookup):
+            external_key, lookup_class, lookup_field = lookup
+            if not old_value:
+                return None
+            value = await self.itop.schema(lookup_class).find({lookup_field: old_value}, ['id'])
+            if value == [] or value == '':
+                raise ValueError(
+                    'Lookup field Error. ' +
+                    'From: field "%s", value "%s", key "%s", schema "%s" To: field "%s" on schema "%s"' %
+                    (field, old_value, external_key, schema, lookup_field, lookup_class))
+            return value
+
+        schema_lookups = self.itop.data_model.lookupExternalField(self.name)
+        obj_lookups = [field for field in obj if field in schema_lookups]
+        values = await asyncio.gather(*[
+            resolve(self.name, field, obj[field], schema_lookups[field]) for field in obj_lookups
+        ])
+        for field, value in zip(obj_lookups, values):
+            obj[schema_lookups[field][0]] = value
+            del obj[field]
+
+        schema_external_keys = list(set([v[0] for _, v in schema_lookups.items()]))
+        for field in [field for field in obj if field in schema_external_keys]:
+            if not obj[field]:
+                del obj[field]
+
+        schema_linked_sets = self.itop.data_model.lookupLinkedSet(self.name)
+        for field_linked_set in [field for field in obj if field in schema_linked_sets]:
+            linked_class, _, _ = schema_linked_sets[field_linked_set]
+            linked_sets_lookups = self.itop.data_model.lookupExternalField(linked_class)
+            for child_obj in obj[field_linked_set]:
+                child_lookups = [field for field in child_obj if field in linked_sets_lookups]
+                values = await asyncio.gather(*[
+                    resolve(self.name, field, child_obj[field], linked_sets_lookups[field]) for field in child_lookups
+                ])
+                for field, value in zip(child_lookups, values):
+                    child_obj[linked_sets_lookups[field][0]] = value
+                    del child_obj[field]
+
+        return obj
+
+    async def apply_stimulus(self, query, stimulus_data, stimulus="env_assign"):
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        stimulus_data = stimulus_data if stimulus_data else {}
+        if not isinstance(stimulus_data, dict):
+            raise TypeError("Stimulus data must be a dict")
+
+        key = self.to_oql(query)
+
+        if self.itop.data_model:
+            stimulus_data = await self.lookup(stimulus_data)
+
+        update_data = {
+            'operation': 'core/apply_stimulus',
+            'comment': 'Apply Stimulus ' + self.name,
+            'class': self.name,
+            'output_fields': "*",
+            'fields': stimulus_data,
+            'stimulus': stimulus,
+            'key': key
+        }
+
+        return await self.itop.request(update_data)
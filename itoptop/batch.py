@@ -0,0 +1,100 @@
+import contextvars
+import json
+import threading
+
+from .exceptions import BatchError
+
+PHASES = {'core/create': 0, 'core/update': 1, 'core/apply_stimulus': 2, 'core/delete': 3}
+
+# batches open in the current thread (and the scheduler workers it starts), see Itop.active_batch
+BATCHES = contextvars.ContextVar('itoptop_batches', default=())
+
+
+class Batch(object):
+    def __init__(self, itop, comment=None, workers=10):
+        """
+        Writes of itop deferred until the block ends, see Itop.batch.
+        :param itop: Itop
+        :param comment: Optional. Comment of every write of the batch, instead of the one of each method.
+        :param workers: Optional. Parallel requests of the flush. default is 10.
+        """
+        self.itop = itop
+        self.comment = comment
+        self.workers = workers
+        self.writes = []  # (data, raw_response)
+        self.updates = {}  # (class, key, output_fields) = index in writes of the pending update
+        self.coalesced = 0
+        self.results = []
+        self.parent = None
+        self._token = None
+        self._lock = threading.Lock()  # workers of parallel methods add writes concurrently
+
+    def add(self, data, raw_response=False):
+        """
+        Queue a write. Updates of the same key are merged into the pending one, later fields win.
+        :return: empty result, the response is known after the flush
+        """
+        data = dict(data)
+        if self.comment is not None:
+            data['comment'] = self.comment
+        operation, schema = data.get('operation'), data.get('class')
+        key = json.dumps(data.get('key'), sort_keys=True, default=str)
+
+        with self._lock:
+            if operation == 'core/update':
+                index = self.updates.get((schema, key, data.get('output_fields')))
+                if index is not None:
+                    pending = self.writes[index][0]
+                    pending['fields'] = {**(pending.get('fields') or {}), **(data.get('fields') or {})}
+                    self.coalesced += 1
+                    return {} if raw_response else []
+                self.updates[(schema, key, data.get('output_fields'))] = len(self.writes)
+            elif operation != 'core/create':
+                # a stimulus or delete may touch any pending update of the class, next updates are not merged over it
+                self.updates = {k: v for k, v in self.updates.items() if k[0] != schema}
+
+            self.writes.append((data, raw_response))
+        return {} if raw_response else []
+
+    def flush(self):
+        """
+        Send queued writes with the itop scheduler. Consecutive creates, updates, stimuli or deletes are sent in
+        parallel, each run after the previous one, so an update queued after a create finds the created object.
+        :return: list of responses, in the order writes were queued
+        """
+        with self._lock:
+            writes, self.writes, self.updates = self.writes, [], {}
+        runs = []
+        for write in writes:
+            phase = PHASES.get(write[0].get('operation'))
+            if not runs or runs[-1][0] != phase:
+                runs.append((phase, []))
+            runs[-1][1].append(write)
+
+        results = []
+        for _, run in runs:
+            results += self.itop.scheduler.map(lambda write: self.itop.request(*write), run, self.workers)
+
+        if self.itop.lookup_cache is not None:
+            for schema in set(data.get('class') for data, _ in writes):
+                self.itop.lookup_cache.invalidate_schema(self.itop.related_schemas(schema))
+
+        self.results = results
+        errors = [(i, result.error) for i, result in enumerate(results) if result.error is not None]
+        if errors:
+            raise BatchError(results, errors)
+        return [result.value for result in results]
+
+    def __enter__(self):
+        # a nested batch joins the outer one
+        self.parent = self.itop.active_batch()
+        if self.parent is None:
+            self._token = BATCHES.set(BATCHES.get() + (self,))
+        return self.parent or self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.parent is not None:
+            return
+        BATCHES.reset(self._token)
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,210 @@
+"""
+Streaming readers and writers of CSV, JSON lines and Parquet files, for Schema.import_file and Schema.export_file.
+Parquet requires pyarrow (pip install itoptop[parquet]).
+"""
+import csv
+import json
+import os
+import queue
+import threading
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+def file_format(filename, format=None):
+    """
+    :return: format given or guessed from the file extension
+    """
+    if format is None:
+        extension = os.path.splitext(filename)[1].lower().lstrip('.')
+        format = {'json': 'jsonl', 'ndjson': 'jsonl', 'pq': 'parquet'}.get(extension, extension)
+    if format not in FORMATS:
+        raise ValueError('Unknown file format %r, expected one of %s' % (format, ", ".join(FORMATS)))
+    return format
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('pyarrow is required for parquet files: pip install itoptop[parquet]')
+    return pyarrow
+
+
+def _decode(value):
+    # linked sets are written as json lists in csv and parquet files
+    if isinstance(value, str) and value.startswith('[{') and value.endswith('}]'):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _encode(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def read_chunks(filename, format=None, chunk_size=1000, delimiter=',', encoding='utf-8'):
+    """
+    Read a file in lists of at most chunk_size rows, so memory does not grow with the file size.
+    :return: generator of lists of dicts
+    """
+    format = file_format(filename, format)
+    if format == 'parquet':
+        parquet = _pyarrow().parquet
+        for batch in parquet.ParquetFile(filename).iter_batches(batch_size=chunk_size):
+            yield [{k: _decode(v) for k, v in row.items()} for row in batch.to_pylist()]
+        return
+
+    chunk = []
+    with open(filename, encoding=encoding, newline='') as f:
+        if format == 'csv':
+            rows = ({k: _decode(v) for k, v in row.items()} for row in csv.DictReader(f, delimiter=delimiter))
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def prefetch(chunks, size=2):
+    """
+    Read chunks in a background thread, at most size chunks ahead of the consumer.
+    :return: generator of chunks
+    """
+    pending = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((None, e))
+
+    thread = threading.Thread(target=read, name='itoptop-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk, error = pending.get()
+            if error is not None:
+                raise error
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+def write_rows(filename, rows, fields=None, format=None, chunk_size=1000, delimiter=',', encoding='utf-8'):
+    """
+    Write rows to a file as they are produced. The file is written aside and renamed when complete.
+    :param rows: iterable of dicts
+    :param fields: Optional. Columns, default is the keys of the first row.
+    :return: number of rows written
+    """
+    format = file_format(filename, format)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    count = 0
+    rows = iter(rows)
+    try:
+        if format == 'parquet':
+            pyarrow = _pyarrow()
+            writer = None
+            try:
+                while True:
+                    batch = [row for _, row in zip(range(chunk_size), rows)]
+                    if not batch:
+                        break
+                    if writer is None:
+                        fields = fields or list(batch[0])
+                        schema = pyarrow.schema([(field, pyarrow.string()) for field in fields])
+                        writer = pyarrow.parquet.ParquetWriter(tmp, schema)
+                    columns = {field: [None if row.get(field) is None else str(_encode(row.get(field)))
+                                       for row in batch] for field in fields}
+                    writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+                    count += len(batch)
+                if writer is None:
+                    if not fields:
+                        return 0
+                    writer = pyarrow.parquet.ParquetWriter(
+                        tmp, pyarrow.schema([(field, pyarrow.string()) for field in fields]))
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            with open(tmp, 'w', encoding=encoding, newline='') as f:
+                if format == 'csv':
+                    writer = None
+                    for row in rows:
+                        if writer is None:
+                            writer = csv.DictWriter(f, fields or list(row), delimiter=delimiter,
+                                                    extrasaction='ignore')
+                            writer.writeheader()
+                        writer.writerow({k: _encode(v) for k, v in row.items()})
+                        count += 1
+                    if writer is None and fields:
+                        csv.DictWriter(f, fields, delimiter=delimiter).writeheader()
+                else:
+                    for row in rows:
+                        if fields:
+                            row = {field: row.get(field) for field in fields}
+                        f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                        count += 1
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return count
+
+
+class Checkpoint(object):
+    def __init__(self, path, filename):
+        """
+        Rows of filename already written, saved in a json file after each chunk.
+        :param path: checkpoint json file
+        :param filename: file being imported, its size and modification time must not change between runs
+        """
+        self.path = path
+        stat = os.stat(filename)
+        self.key = {'filename': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        self.offset = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('key') != self.key:
+                raise ValueError('Checkpoint %s belongs to another file or the file changed since: %s' %
+                                 (path, saved.get('key')))
+            self.offset = saved['offset']
+
+    def save(self, offset):
+        self.offset = offset
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'key': self.key, 'offset': offset}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
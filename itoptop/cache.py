@@ -0,0 +1,254 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=10000, ttl=None):
+        """
+        Thread-safe LRU cache with optional time to live.
+        :param maxsize: Maximum number of entries. 0 disables the cache.
+        :param ttl: Optional. Seconds an entry is valid. None never expires.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._delete(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if not self.maxsize:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._delete(next(iter(self._data)))
+
+    def _delete(self, key):
+        del self._data[key]
+
+    def invalidate(self, predicate=None):
+        """
+        Remove entries.
+        :param predicate: Optional. Function receiving the key, entries which it returns true are removed.
+            If omitted, clear the cache.
+        """
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if predicate(key)]:
+                self._delete(key)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LookupCache(LRUCache):
+    """
+    Cache of lookup resolutions indexed by (lookup_class, lookup_field, value). Not found results are cached too.
+    Keys are also indexed by lookup class, so invalidating a class does not scan the cache.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        super(LookupCache, self).__init__(maxsize, ttl)
+        self._classes = {}  # lookup class = set of keys
+
+    def set(self, key, value, ttl=None):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._classes.setdefault(key[0], set()).add(key)
+            super(LookupCache, self).set(key, value, ttl)
+
+    def _delete(self, key):
+        del self._data[key]
+        keys = self._classes.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._classes[key[0]]
+
+    def invalidate(self, predicate=None):
+        with self._lock:
+            super(LookupCache, self).invalidate(predicate)
+            if predicate is None:
+                self._classes.clear()
+
+    def invalidate_schema(self, names):
+        """
+        Remove resolutions of lookup classes.
+        :param names: class or list of classes, e.g. Itop.related_schemas of the written class, since a lookup on
+            a parent class (FunctionalCI) finds objects of its subclasses (Server).
+        """
+        with self._lock:
+            for name in [names] if isinstance(names, str) else names:
+                for key in list(self._classes.pop(name, ())):
+                    del self._data[key]
+
+
+class ResponseCache(object):
+    operations = ('core/get', 'core/get_related')
+
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl=60, ttls=None, path=None):
+        """
+        Read-through cache of core/get and core/get_related responses, keyed by the normalized request.
+        Entries are stored serialized, so each hit returns new objects. Concurrent identical requests wait for a
+        single request to iTop.
+        :param max_bytes: Maximum size of cached responses kept in memory, least recently used are evicted.
+        :param ttl: Seconds a response is valid.
+        :param ttls: Optional. dict index by class = seconds, overriding ttl.
+        :param path: Optional. sqlite file shared by processes, used behind the memory cache.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.path = path
+        self.hits = self.misses = self.waits = 0
+        self.size = 0
+        self._data = OrderedDict()  # key = (value, expires, class, operation)
+        self._inflight = {}
+        self._generations = {}
+        self._lock = threading.RLock()
+        self._db = None
+        if path:
+            import sqlite3
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                             '(key TEXT PRIMARY KEY, class TEXT, operation TEXT, expires REAL, value BLOB)')
+
+    @staticmethod
+    def key(data, raw_response=False):
+        import json
+        return json.dumps([data, raw_response], sort_keys=True, default=str)
+
+    def _get(self, key):
+        from . import codec
+        now = time.time()
+        item = self._data.get(key)
+        if item is not None:
+            value, expires = item[:2]
+            if expires > now:
+                self._data.move_to_end(key)
+                return codec.loads(value)
+            self._pop(key)
+        if self._db is not None:
+            row = self._db.execute('SELECT value, expires, class, operation FROM responses WHERE key = ?',
+                                   (key,)).fetchone()
+            if row and row[1] > now:
+                self._put(key, row[0], row[1], row[2], row[3])
+                return codec.loads(row[0])
+        return None
+
+    def _generation(self, schema, operation):
+        # core/get_related responses cross classes, any write makes them stale
+        scope = '*' if operation == 'core/get_related' else schema
+        return self._generations.get(scope, 0), self._generations.get(None, 0)
+
+    def _put(self, key, value, expires, schema, operation):
+        self._pop(key)
+        if len(value) > self.max_bytes:
+            return
+        self._data[key] = (value, expires, schema, operation)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._data)))
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0])
+
+    def fetch(self, data, raw_response, loader):
+        """
+        Cached response of data, calling loader on a miss.
+        :param data: request data
+        :param raw_response: request raw_response flag, part of the key
+        :param loader: function doing the request
+        :return: response
+        """
+        from . import codec
+        key = self.key(data, raw_response)
+        schema = data.get('class')
+        operation = data.get('operation')
+        while True:
+            with self._lock:
+                value = self._get(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    generation = self._generation(schema, operation)
+                    self.misses += 1
+                    break
+                self.waits += 1
+            event.wait()
+
+        try:
+            value = loader()
+            encoded = codec.dumps(value).encode('utf-8')
+            expires = time.time() + self.ttls.get(schema, self.ttl)
+            with self._lock:
+                # a write invalidated the class while requesting, the response may be stale
+                if generation == self._generation(schema, operation):
+                    self._put(key, encoded, expires, schema, operation)
+                    if self._db is not None:
+                        self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                         (key, schema, operation, expires, encoded))
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def invalidate(self, schemas=None):
+        """
+        Remove responses of classes, and every core/get_related response since they cross classes.
+        :param schemas: Optional. list of classes. If omitted, clear the cache.
+        """
+        with self._lock:
+            if schemas is None:
+                self._generations[None] = self._generations.get(None, 0) + 1
+                self._data.clear()
+                self.size = 0
+                if self._db is not None:
+                    self._db.execute('DELETE FROM responses')
+                return
+            schemas = set(schemas)
+            for schema in schemas | {'*'}:
+                self._generations[schema] = self._generations.get(schema, 0) + 1
+            for key in [key for key, item in self._data.items()
+                        if item[2] in schemas or item[3] == 'core/get_related']:
+                self._pop(key)
+            if self._db is not None and schemas:
+                self._db.execute('DELETE FROM responses WHERE operation = ? OR class IN (%s)' %
+                                 ", ".join('?' * len(schemas)), ['core/get_related'] + list(schemas))
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'waits': self.waits}
@@ -0,0 +1,26 @@
+import json
+import os
+
+CHANGE_CLASS = 'CMDBChangeOp'
+DELETE_CLASS = 'CMDBChangeOpDelete'
+
+
+class Watermarks(dict):
+    def __init__(self, path=None):
+        """
+        Last CMDBChangeOp id read by Schema.changes, index by class. Persisted as a json file.
+        :param path: Optional. json file, loaded if it exists. If omitted, watermarks are kept in memory only.
+        """
+        super().__init__()
+        self.path = path
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.update(json.load(f))
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self, f, sort_keys=True)
+        os.replace(tmp, self.path)
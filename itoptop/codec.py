@@ -0,0 +1,112 @@
+"""
+JSON encoding of requests and decoding of responses. orjson is used when installed.
+"""
+try:
+    import orjson
+
+    backend = 'orjson'
+
+    def dumps(data):
+        return orjson.dumps(data).decode('utf-8')
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    backend = 'json'
+    dumps = json.dumps
+    loads = json.loads
+
+
+def clean_objects(objects):
+    """
+    Convert iTop objects to a list of its fields, with the key as id, reusing the parsed fields dicts.
+    :param objects: dict of 'objects' from an iTop response
+    :return: list of objects
+    """
+    output = []
+    for obj in objects.values():
+        fields = obj['fields']
+        if fields is None:
+            fields = {}
+        fields['id'] = obj['key']
+        output.append(fields)
+    return output
+
+
+def iter_objects(chunks, header):
+    """
+    Incremental parser of an iTop response. Objects are yielded one by one while the body is read, so the whole
+    response is never held in memory.
+    :param chunks: iterable of bytes
+    :param header: dict filled with the other members of the response, as code and message
+    :return: generator of iTop objects, with class, key and fields
+    """
+    import codecs
+    import json
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def fill():
+        if state['eof']:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            state['eof'] = True
+            text = utf8.decode(b'', final=True)
+        else:
+            text = utf8.decode(chunk)
+        state['buf'] = state['buf'][state['pos']:] + text
+        state['pos'] = 0
+        return True
+
+    def peek():
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise json.JSONDecodeError('Unexpected end of response', state['buf'], state['pos'])
+
+    def expect(char):
+        if peek() != char:
+            raise json.JSONDecodeError('Expecting %r' % char, state['buf'], state['pos'])
+        state['pos'] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                result, end = decoder.raw_decode(state['buf'], state['pos'])
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(state['buf']) or state['eof']:
+                    state['pos'] = end
+                    return result
+            except json.JSONDecodeError:
+                if state['eof']:
+                    raise
+            fill()
+
+    expect('{')
+    while peek() != '}':
+        key = value()
+        expect(':')
+        if key == 'objects' and peek() == '{':
+            state['pos'] += 1
+            while peek() != '}':
+                value()
+                expect(':')
+                yield value()
+                if peek() == ',':
+                    state['pos'] += 1
+            state['pos'] += 1
+        else:
+            header[key] = value()
+        if peek() == ',':
+            state['pos'] += 1
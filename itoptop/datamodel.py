@@ -1,23 +1,238 @@
+import hashlib
+import json
+import os
+
+from .metrics import timed
+
+CACHE_VERSION = 3
+FIELD_PROPERTIES = ('extkey_attcode', 'target_attcode', 'target_class', 'linked_class', 'ext_key_to_me',
+                    'ext_key_to_remote')
+NEIGHBOUR_PROPERTIES = ('attribute', 'query_down', 'query_up', 'direction')
+# children of a class definition, other <class id="..."/> elements are references (e.g. in user_rights)
+CLASS_ELEMENTS = ('parent', 'fields', 'properties')
+
+
+def _local(name):
+    """
+    Name without namespace or prefix, so xsi:type is read as type.
+    """
+    return name.rsplit('}', 1)[-1].rsplit(':', 1)[-1]
+
+
+def _iterparse(filename):
+    try:
+        from lxml import etree
+        return etree.iterparse(filename, events=('end',), tag='class', recover=True, huge_tree=True)
+    except ImportError:
+        from xml.etree import ElementTree
+        return ElementTree.iterparse(filename, events=('end',))
+
+
+def compile_classes(filename):
+    """
+    Read a datamodel xml in a single streaming pass, keeping only classes metadata.
+    Each class element is released as soon as it is read, so the full tree is never held.
+    :param filename:
+    :return: dict index by class = {'parent': parent class, 'fields': dict index by field = {'type': type, ...},
+        'relations': dict index by relation = list of neighbours {'id': id, 'attribute': field, ...}}
+    """
+    classes = {}
+
+    for _, elem in _iterparse(filename):
+        if not isinstance(elem.tag, str) or _local(elem.tag) != 'class' or 'id' not in elem.attrib:
+            continue
+        if not any(isinstance(child.tag, str) and _local(child.tag) in CLASS_ELEMENTS for child in elem):
+            elem.clear()
+            continue
+
+        fields = {}
+        for node in elem.iter('field'):
+            if 'id' not in node.attrib:
+                continue
+            field = {'type': next((v for k, v in node.attrib.items() if _local(k) == 'type'), None)}
+            for child in node:
+                if isinstance(child.tag, str) and _local(child.tag) in FIELD_PROPERTIES:
+                    field[_local(child.tag)] = (child.text or '').strip()
+            fields[node.attrib['id']] = field
+
+        relations = {}
+        for relation in (node for group in elem.iter('relations') for node in group):
+            if not isinstance(relation.tag, str) or 'id' not in relation.attrib:
+                continue
+            neighbours = relations.setdefault(relation.attrib['id'], [])
+            for node in relation.iter('neighbour'):
+                neighbour = {'id': node.attrib.get('id')}
+                for child in node:
+                    if isinstance(child.tag, str) and _local(child.tag) in NEIGHBOUR_PROPERTIES:
+                        neighbour[_local(child.tag)] = (child.text or '').strip()
+                neighbours.append(neighbour)
+
+        parent = (elem.findtext('parent') or '').strip() or None
+        classes[elem.attrib['id']] = {'parent': parent, 'fields': fields, 'relations': relations}
+
+        # nested classes are read first and cleared, so their fields are not repeated on the outer class
+        elem.clear()
+        if hasattr(elem, 'iterancestors') and next(elem.iterancestors('class'), None) is None:
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    return classes
+
+
+def _file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_path(filename, cache_dir=None):
+    """
+    Path of the compiled cache of a datamodel xml.
+    :param filename: datamodel xml
+    :param cache_dir: Optional. default is $XDG_CACHE_HOME/itoptop or ~/.cache/itoptop
+    :return: path
+    """
+    if not cache_dir:
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'itoptop')
+    name = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.json')
+
+
+def load_classes(filename, cache=True, cache_dir=None):
+    """
+    Compiled classes of a datamodel, read from the cache while the xml path, size, mtime or hash match.
+    :param filename: datamodel xml, or a precompiled .json saved by DataModel.save
+    :param cache: Optional. If set to false, always parse the xml.
+    :param cache_dir: Optional. Directory of cache files.
+    :return: dict of compile_classes
+    """
+    if filename.endswith('.json'):
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)['classes']
+
+    if not cache:
+        return compile_classes(filename)
+
+    stat = os.stat(filename)
+    key = {'version': CACHE_VERSION, 'path': os.path.abspath(filename), 'size': stat.st_size,
+           'mtime': stat.st_mtime}
+    path = cache_path(filename, cache_dir)
+
+    cached = None
+    try:
+        with open(path, encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    if cached and all(cached['key'].get(k) == v for k, v in key.items()):
+        return cached['classes']
+
+    # touched or copied but same content, there is no need to parse again
+    key['hash'] = _file_hash(filename)
+    if cached and cached['key'].get('hash') == key['hash'] and cached['key'].get('version') == CACHE_VERSION:
+        classes = cached['classes']
+    else:
+        classes = compile_classes(filename)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'classes': classes}, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return classes
+
+
 class DataModel(object):
-    def __init__(self, filename):
+    metrics = None
+
+    def __init__(self, filename, cache=True, cache_dir=None):
         """
-        Create Data Model
-        :param filename:
+        Create Data Model. The xml is compiled once into a class index, every lookup is answered from dicts.
+        The index is cached on disk and reused while the xml does not change.
+        :param filename: datamodel xml, or a precompiled .json saved by DataModel.save
+        :param cache: Optional. If set to false, do not read or write the compiled cache. default is true.
+        :param cache_dir: Optional. Directory of cache files. default is ~/.cache/itoptop
         """
-        import re
-        from lxml import etree
-        xml = open(filename, encoding='utf-8', errors='replace').read()
-        xml = re.sub('xmlns(:xsi|)="[^"]+"', '', xml, count=1)
-        xml = re.sub('xsi:', '', xml, count=0)
-        xml = bytes(bytearray(xml, encoding='utf-8'))
-        self.root = etree.XML(xml)
-
-        schemas = [node for node in self.root.xpath("//class") if 'id' in node.attrib]
-        self.schemas = [schema.attrib['id'] for schema in schemas]  # TODO: get only user visible schemas  
+        self.classes = load_classes(filename, cache, cache_dir)
+        self.schemas = list(self.classes)  # TODO: get only user visible schemas
 
         self.lookupsExternalFields = {}
         self.lookupLinkedSets = {}
 
+    def save(self, filename):
+        """
+        Save the compiled datamodel, it can be loaded later by DataModel(filename) without the xml.
+        :param filename: .json file
+        """
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'key': {'version': CACHE_VERSION}, 'classes': self.classes}, f)
+
+    def parent(self, schema):
+        """
+        :param schema:
+        :return: parent class or None
+        """
+        return self.classes.get(schema, {}).get('parent')
+
+    def ancestors(self, schema):
+        """
+        :param schema:
+        :return: list of parent classes, nearest first
+        """
+        output = []
+        parent = self.parent(schema)
+        while parent and parent not in output:
+            output.append(parent)
+            parent = self.parent(parent)
+        return output
+
+    def subclasses(self, schema):
+        """
+        :param schema:
+        :return: list of every class derived from schema, at any depth
+        """
+        if not hasattr(self, 'children'):
+            self.children = {}
+            for name, properties in self.classes.items():
+                if properties.get('parent'):
+                    self.children.setdefault(properties['parent'], []).append(name)
+        output = []
+        pending = list(self.children.get(schema, []))
+        while pending:
+            name = pending.pop()
+            if name not in output:
+                output.append(name)
+                pending += self.children.get(name, [])
+        return output
+
+    def fields(self, schema):
+        """
+        Fields declared in the class itself, not inherited.
+        :param schema:
+        :return: dict index by field = {'type': type, ...}
+        """
+        return self.classes.get(schema, {}).get('fields', {})
+
+    def neighbours(self, schema, relation='impacts'):
+        """
+        Neighbours of a relation declared in the class itself, not inherited. The class impacts its neighbours.
+        :return: list of {'id': id, 'attribute': field, 'query_down': oql, ...}
+        """
+        return self.classes.get(schema, {}).get('relations', {}).get(relation, [])
+
+    def field_type(self, schema, field):
+        """
+        :return: attribute type of field declared in schema or None
+        """
+        return self.fields(schema).get(field, {}).get('type')
+
+    @timed('lookupExternalField')
     def lookupExternalField(self, schema):
         """
         Quando um campo externo é enviado para uma inclusão/inserção, o iTop retorna um erro e não faz a referência ao
@@ -41,45 +256,40 @@ class DataModel(object):
 
         if schema in self.lookupsExternalFields:
             return self.lookupsExternalFields[schema]
-        root = self.root
 
         schema_lookups = {}
-        fields = list(set(root.xpath("//class[@id='%s']//field[@type='AttributeExternalField']/@id" % schema)))
-        for field in fields:
-            key = root.xpath("//class[@id='%s']//field[@id='%s']/extkey_attcode/text()" % (schema, field))[0]
-            lookup_field = \
-                root.xpath("//class[@id='%s']//field[@id='%s']/target_attcode/text()" % (schema, field))[0]
+        for field, properties in self.fields(schema).items():
+            if properties['type'] != 'AttributeExternalField':
+                continue
+            key = properties.get('extkey_attcode')
+            lookup_field = properties.get('target_attcode')
+            if not key or not lookup_field:
+                continue
             # The key can be defined in a parent class
             # cycle through the current schema and its parent until we find the right field
             current_schema = schema
             while current_schema:
-                if not root.xpath("//class[@id='%s']//field[@id='%s']/@type" % (current_schema, key)):
-                    parent = root.xpath("//class[@id='%s']/parent/text()" % current_schema)
-                    if parent:
-                        current_schema = parent[0]
-                    else:
-                        current_schema = None
+                key_type = self.field_type(current_schema, key)
+                if not key_type:
+                    current_schema = self.parent(current_schema)
+                    continue
+                if key_type == 'AttributeHierarchicalKey':
+                    lookup_schema = current_schema
                 else:
-                    if root.xpath("//class[@id='%s']//field[@id='%s']/@type" % (current_schema, key))[0] == 'AttributeHierarchicalKey':
-                        lookup_schema = current_schema
-                    else:
-                        target_class = root.xpath("//class[@id='%s']//field[@id='%s']/target_class/text()" % (current_schema, key))[0]
-                        lookup_schema = target_class
-                    schema_lookups[field] = (key, lookup_schema, lookup_field)
-                    break
-
-        parent = root.xpath("//class[@id='%s']/parent/text()" % schema)
-        if len(parent) > 0:
-            parent = parent[0]
-            if parent != 'cmdbAbstractObject':  # TODO: improve this
-                import copy
-                lookups_inheritance = copy.deepcopy(self.lookupExternalField(parent))
-                lookups_inheritance.update(schema_lookups)
-                schema_lookups = lookups_inheritance
+                    lookup_schema = self.fields(current_schema)[key].get('target_class')
+                schema_lookups[field] = (key, lookup_schema, lookup_field)
+                break
+
+        parent = self.parent(schema)
+        if parent and parent != 'cmdbAbstractObject':  # TODO: improve this
+            lookups_inheritance = dict(self.lookupExternalField(parent))
+            lookups_inheritance.update(schema_lookups)
+            schema_lookups = lookups_inheritance
 
         self.lookupsExternalFields[schema] = schema_lookups
         return schema_lookups
 
+    @timed('lookupLinkedSet')
     def lookupLinkedSet(self, schema):
         """
         Quando um campo é do tipo linked set (relação N-N) é necessário saber qual a classe meio.
@@ -89,16 +299,21 @@ class DataModel(object):
 
         if schema in self.lookupLinkedSets:
             return self.lookupLinkedSets[schema]
-        root = self.root
 
         schema_lookups = {}
-        fields = list(set(root.xpath("//class[@id='%s']//field[@type='AttributeLinkedSetIndirect']/@id" % schema)))
-        for field in fields:
-
-            linked_class = root.xpath("//class[@id='%s']//field[@id='%s']/linked_class/text()" % (schema, field))[0]
-            ext_key_to_me = root.xpath("//class[@id='%s']//field[@id='%s']/ext_key_to_me/text()" % (schema, field))[0]
-            ext_key_to_remote = root.xpath("//class[@id='%s']//field[@id='%s']/ext_key_to_remote/text()" % (schema, field))[0]
-            schema_lookups[field] = (linked_class, ext_key_to_me, ext_key_to_remote)
+        for field, properties in self.fields(schema).items():
+            if properties['type'] == 'AttributeLinkedSetIndirect':
+                schema_lookups[field] = (properties.get('linked_class'), properties.get('ext_key_to_me'),
+                                         properties.get('ext_key_to_remote'))
 
         self.lookupLinkedSets[schema] = schema_lookups
         return schema_lookups
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Precompile an iTop datamodel xml.')
+    parser.add_argument('xml', help='datamodel xml, e.g. itop_folder/data/datamodel-production.xml')
+    parser.add_argument('output', help='compiled .json')
+    args = parser.parse_args()
+    DataModel(args.xml, cache=False).save(args.output)
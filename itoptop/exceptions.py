@@ -1,5 +1,6 @@
 import requests
-import json
+
+from . import codec
 
 itop_error_codes = {
     0: 'OK - No issue has been encountered',
@@ -27,7 +28,9 @@ class ItopError(requests.exceptions.ConnectionError):
                 hasattr(response, 'request')):
             self.request = self.response.request
 
-        json_return = json.loads(response.content.decode('utf-8'))
+        json_return = kwargs.pop('json_return', None)
+        if json_return is None:
+            json_return = codec.loads(response.content)
         return_code = json_return['code']
         message = json_return['message']
 
@@ -36,4 +39,17 @@ class ItopError(requests.exceptions.ConnectionError):
         else:
             itop_error = "UNKNOW_ERROR - Not specified by ITOP."
 
-        super(ItopError, self).__init__(message + "\n" + itop_error)
\ No newline at end of file
+        super(ItopError, self).__init__(message + "\n" + itop_error)
+
+
+class BatchError(Exception):
+    def __init__(self, results, errors):
+        """
+        Some requests of a batch failed, after all of them were done.
+        :param results: list of Result of every item, successful ones included.
+        :param errors: list of (index, exception) of the failed items.
+        """
+        self.results = results
+        self.errors = errors
+        super(BatchError, self).__init__("%d of %d requests failed. First error: %s" %
+                                         (len(errors), len(results), errors[0][1]))
@@ -0,0 +1,261 @@
+import re
+from array import array
+
+# link class = external key of the impacting side, for datamodels compiled without <relations>
+LINK_IMPACTS = {
+    'lnkApplicationSolutionToFunctionalCI': 'functionalci_id',
+    'lnkApplicationSolutionToBusinessProcess': 'applicationsolution_id',
+    'lnkConnectableCIToNetworkDevice': 'networkdevice_id',
+    'lnkSanToDatacenterDevice': 'san_id',
+    'lnkServerToVolume': 'volume_id',
+    'lnkVirtualDeviceToVolume': 'volume_id',
+}
+
+# neighbour query of the simplest form: SELECT Class [AS alias] WHERE [alias.]key = :this->id
+QUERY_DOWN = re.compile(r'^\s*SELECT\s+(\w+)(?:\s+AS\s+(\w+))?\s+WHERE\s+(?:(\w+)\.)?(\w+)\s*=\s*:this->id\s*$',
+                        re.IGNORECASE)
+
+
+class RelationGraph(object):
+    def __init__(self, itop, root='FunctionalCI', links=None, page_size=1000):
+        """
+        Local snapshot of relation edges between objects, to answer impacts/depends on traversals without a
+        core/get_related request for each object.
+
+        By default, edges come from the impacts neighbours declared in the datamodel <relations> of the root class
+        and its subclasses: a class impacts the objects of the neighbour attribute (external key or linked set), or
+        of its query_down when it is a simple "SELECT Class WHERE key = :this->id". Other queries are skipped.
+        Datamodels without relations fall back to the fields: the target of an external key impacts the object
+        holding the key, and each link class of linked sets gets one orientation (see LINK_IMPACTS).
+
+        Edges are kept in CSR arrays (offsets and targets) for each direction.
+
+        :param itop: Itop with data model.
+        :param root: Optional. Class whose subclasses are in the graph. default is FunctionalCI.
+        :param links: Optional. list of (schema, from_key, to_key, from_class, to_class), where the object pointed
+            by from_key impacts the object pointed by to_key ('id' is the object itself). Overrides the datamodel.
+        :param page_size: Optional. Objects requested per page when reading edges.
+        """
+        self.itop = itop
+        self.page_size = page_size
+        self.links = links if links is not None else self.datamodel_links(root)
+
+        self.nodes = {}  # (root class, id) = index
+        self.keys = []  # index = (root class, id)
+        self.classes = []  # index = declared class
+        self.edges = None  # link = {object id: (from index, to index)}, None before the snapshot
+        self.change_id = 0
+        self._forward = self._backward = None
+
+    def field(self, schema, field):
+        data_model = self.itop.data_model
+        for current in [schema] + data_model.ancestors(schema):
+            properties = data_model.fields(current).get(field)
+            if properties is not None:
+                return properties
+        return {}
+
+    def datamodel_links(self, root):
+        data_model = self.itop.data_model
+        scope = set([root] + data_model.subclasses(root))
+        if any(data_model.neighbours(schema) for schema in scope):
+            return self.relation_links(scope)
+
+        links = []
+        for schema in sorted(scope):
+            for field, properties in data_model.fields(schema).items():
+                if properties['type'] == 'AttributeExternalKey' and properties.get('target_class') in scope:
+                    links.append((schema, field, 'id', properties['target_class'], schema))
+            for field, (linked_class, ext_key_to_me, ext_key_to_remote) in data_model.lookupLinkedSet(schema).items():
+                remote = self.field(linked_class, ext_key_to_remote).get('target_class')
+                if remote not in scope or any(link[0] == linked_class for link in links):
+                    # a link class declared on both sides is oriented once
+                    continue
+                if LINK_IMPACTS.get(linked_class) == ext_key_to_me:
+                    links.append((linked_class, ext_key_to_me, ext_key_to_remote, schema, remote))
+                else:
+                    links.append((linked_class, ext_key_to_remote, ext_key_to_me, remote, schema))
+        return links
+
+    def relation_links(self, scope):
+        """
+        Links of the impacts neighbours declared in the datamodel, each class impacting its neighbours.
+        """
+        data_model = self.itop.data_model
+        links = []
+        for schema in sorted(scope):
+            for neighbour in data_model.neighbours(schema) or []:
+                link = None
+                attribute = neighbour.get('attribute')
+                properties = self.field(schema, attribute) if attribute else {}
+                if properties.get('type') in ('AttributeExternalKey', 'AttributeHierarchicalKey'):
+                    link = (schema, 'id', attribute, schema, properties.get('target_class') or schema)
+                elif properties.get('type') == 'AttributeLinkedSetIndirect':
+                    remote = self.field(properties['linked_class'], properties['ext_key_to_remote']).get('target_class')
+                    link = (properties['linked_class'], properties['ext_key_to_me'], properties['ext_key_to_remote'],
+                            schema, remote)
+                elif properties.get('type') == 'AttributeLinkedSet':
+                    link = (properties['linked_class'], properties['ext_key_to_me'], 'id', schema,
+                            properties['linked_class'])
+                elif not attribute:
+                    match = QUERY_DOWN.match(neighbour.get('query_down') or '')
+                    if match and match.group(3) in (None, match.group(2)):
+                        link = (match.group(1), match.group(4), 'id', schema, match.group(1))
+                if link is not None and link[4] in scope and link not in links:
+                    links.append(link)
+        return links
+
+    def ancestors(self, schema):
+        data_model = self.itop.data_model
+        return [name for name in data_model.ancestors(schema) if name != 'cmdbAbstractObject'] if data_model else []
+
+    def root_class(self, schema):
+        return ([schema] + self.ancestors(schema))[-1]
+
+    def node(self, schema, key):
+        ancestors = self.ancestors(schema)
+        node_key = (([schema] + ancestors)[-1], str(key))
+        index = self.nodes.get(node_key)
+        if index is None:
+            index = self.nodes[node_key] = len(self.keys)
+            self.keys.append(node_key)
+            self.classes.append(schema)
+        elif self.classes[index] in ancestors:
+            # keep the most specific class known for the object
+            self.classes[index] = schema
+        return index
+
+    def read_edges(self, link, query=None):
+        schema, from_key, to_key, from_class, to_class = link
+        fields = [key for key in (from_key, to_key) if key != 'id'] + ['id']
+        edges = {}
+        for obj in self.itop.schema(schema).iter_find(query, fields, page_size=self.page_size):
+            source = obj['id'] if from_key == 'id' else obj.get(from_key)
+            target = obj['id'] if to_key == 'id' else obj.get(to_key)
+            if source in (None, '', '0', 0) or target in (None, '', '0', 0):
+                continue
+            edges[str(obj['id'])] = (self.node(from_class, source), self.node(to_class, target))
+        return edges
+
+    def snapshot(self):
+        """
+        Read every edge. The current change id is kept for refresh.
+        :return: self
+        """
+        self.change_id = self.itop.schema('CMDBChangeOp').max_id()
+        self.edges = {link: self.read_edges(link) for link in self.links}
+        self._forward = self._backward = None
+        return self
+
+    def refresh(self):
+        """
+        Read again only the edges of objects changed since the last snapshot or refresh, using the CMDBChangeOp
+        history. Edges of deleted objects are removed.
+        :return: number of changed objects
+        """
+        if self.edges is None:
+            self.snapshot()
+            return 0
+
+        data_model = self.itop.data_model
+        classes = {}
+        for link in self.links:
+            classes.setdefault(link[0], []).append(link)
+
+        objclasses = set()
+        for schema in classes:
+            objclasses.update([schema] + (data_model.subclasses(schema) if data_model else []))
+
+        changed = {}
+        change_id = self.change_id
+        query = {'id': {'$gt': self.change_id}, 'objclass': sorted(objclasses)}
+        for change in self.itop.schema('CMDBChangeOp').iter_find(query, ['id', 'objclass', 'objkey'],
+                                                                  page_size=self.page_size):
+            change_id = max(change_id, int(change['id']))
+            objclass = change['objclass']
+            for schema in [objclass] + self.ancestors(objclass):
+                if schema in classes:
+                    changed.setdefault(schema, set()).add(str(change['objkey']))
+
+        for schema, ids in changed.items():
+            for link in classes[schema]:
+                edges = self.edges.setdefault(link, {})
+                for key in ids:
+                    edges.pop(key, None)
+                edges.update(self.read_edges(link, {'id': sorted(ids, key=int)}))
+
+        self.change_id = change_id
+        if changed:
+            self._forward = self._backward = None
+        return sum(len(ids) for ids in changed.values())
+
+    def csr(self, reverse=False):
+        """
+        Compressed sparse rows of the edges.
+        :param reverse: If set to true, edges from the impacted object to the impacting one.
+        :return: (offsets, targets) arrays, targets of node i are targets[offsets[i]:offsets[i + 1]]
+        """
+        cached = self._backward if reverse else self._forward
+        if cached is not None:
+            return cached
+
+        size = len(self.keys)
+        counts = array('l', [0]) * (size + 1)
+        pairs = [(target, source) if reverse else (source, target)
+                 for edges in (self.edges or {}).values() for source, target in edges.values()]
+        for source, _ in pairs:
+            counts[source + 1] += 1
+        for i in range(size):
+            counts[i + 1] += counts[i]
+        targets = array('l', [0]) * len(pairs)
+        position = array('l', counts)
+        for source, target in pairs:
+            targets[position[source]] = target
+            position[source] += 1
+
+        if reverse:
+            self._backward = (counts, targets)
+        else:
+            self._forward = (counts, targets)
+        return counts, targets
+
+    def find_related(self, schema, query=None, relation='impacts', depth=20, direction='down'):
+        """
+        Related objects from the local graph, with the same relation, depth and direction of Schema.find_related.
+        The objects that match the query are included, as in core/get_related.
+        :param schema: class of the query
+        :param query: Optional. Specifies selection filter, or a list of ids.
+        :param relation: Optional. May be 'impacts' or 'depends on'
+        :param depth: Optional. Limitation of iteration depth (default 20).
+        :param direction: Optional. May be 'up' or 'down'
+        :return: list of {'id': id, 'class': class}
+        """
+        if relation not in ('impacts', 'depends on'):
+            raise ValueError("Relation must be 'impacts' or 'depends on'")
+        if direction not in ('up', 'down'):
+            raise ValueError("Direction must be 'up' or 'down'")
+        if self.edges is None:
+            self.snapshot()
+
+        if isinstance(query, list):
+            ids = query
+        else:
+            ids = [obj['id'] for obj in self.itop.schema(schema).iter_find(query, ['id'], page_size=self.page_size)]
+
+        offsets, targets = self.csr(reverse=(relation == 'impacts') != (direction == 'down'))
+        root = self.root_class(schema)
+        frontier = [self.nodes[(root, str(key))] for key in ids if (root, str(key)) in self.nodes]
+        seen = set(frontier)
+        output = [{'id': str(key), 'class': schema} for key in ids]
+        for _ in range(depth):
+            following = []
+            for node in frontier:
+                for target in targets[offsets[node]:offsets[node + 1]]:
+                    if target not in seen:
+                        seen.add(target)
+                        following.append(target)
+                        output.append({'id': self.keys[target][1], 'class': self.classes[target]})
+            if not following:
+                break
+            frontier = following
+        return output
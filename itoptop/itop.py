@@ -1,48 +1,265 @@
-from .datamodel import DataModel
+from . import codec
+from .batch import BATCHES, Batch
+from .cache import LookupCache, ResponseCache
 from .exceptions import ItopError
+from .metrics import Metrics
+from .parallel import Scheduler
 from .schema import Schema
+from .transport import Balancer, Transport
 import requests
-import json
+import threading
+import time
+
+WRITE_OPERATIONS = ('core/create', 'core/update', 'core/delete', 'core/apply_stimulus')
 
 
 class Itop(object):
-    url = version = auth_user = auth_pwd = auth = data_model = None
+    url = version = auth_user = auth_pwd = auth = transport = scheduler = lookup_cache = response_cache = None
+    metrics = journal = None
+    lookup_chunk_size = 500
+    _data_model = _data_model_source = None
+    _check_credentials_pending = False
 
-    def __init__(self, url, version, auth_user, auth_pwd, data_model=None):
+    def __init__(self, url, version, auth_user, auth_pwd, data_model=None, pool_size=10, compress=False,
+                 lookup_cache_size=10000, lookup_cache_ttl=300, lookup_chunk_size=500, check_credentials=True,
+                 timeout=None, retries=3, response_cache=None, metrics=None,
+                 journal=None, weights=None, routing='least_outstanding'):
         """
         Create connection.
-        :param url: iTop rest.php endpoint
+        :param url: iTop rest.php endpoint, or list of endpoints of the same iTop balanced with Balancer
         :param version: API version
         :param auth_user: User
         :param auth_pwd: Password
+        :param data_model: Optional. Path to datamodel xml, precompiled .json or DataModel object.
+            It is only loaded when first used.
+        :param pool_size: Optional. Number of keep-alive connections, should match the workers used. default is 10.
+            With several endpoints, it is the number of connections of each one.
+        :param compress: Optional. If set to true, requests are sent gzip compressed.
+        :param lookup_cache_size: Optional. Maximum lookup resolutions kept in cache, 0 disables it. default is 10000.
+        :param lookup_cache_ttl: Optional. Seconds a lookup resolution is valid. default is 300.
+        :param lookup_chunk_size: Optional. Maximum values resolved by each batch lookup query. default is 500.
+        :param check_credentials: Optional. True checks credentials now, 'deferred' checks them before the first
+            request and False does not check. default is True.
+        :param timeout: Optional. Request timeout in seconds.
+        :param retries: Optional. Retries of timeouts, connection errors and HTTP 5xx in parallel methods. Creates and
+            stimuli are only retried when the connection failed. default is 3.
+        :param response_cache: Optional. ResponseCache for core/get and core/get_related, or True for a default one.
+        :param metrics: Optional. Metrics aggregating requests and lookup spans, or True for a default one.
+        :param journal: Optional. Journal, or path of its sqlite file, recording completed writes so a rerun of an
+            interrupted job skips them.
+        :param weights: Optional. Relative capacities of the endpoints when url is a list.
+        :param routing: Optional. 'least_outstanding' or 'round_robin' when url is a list, see Balancer.
         """
         self.url = url
         self.version = version
         self.auth_user = auth_user
         self.auth_pwd = auth_pwd
+        if isinstance(url, (list, tuple)):
+            probe = {
+                'version': version,
+                'auth_user': auth_user,
+                'auth_pwd': auth_pwd,
+                'json_data': codec.dumps({'operation': 'core/check_credentials', 'user': auth_user,
+                                          'password': auth_pwd})
+            }
+            self.transport = Balancer(url, pool_size=pool_size, compress=compress, timeout=timeout, weights=weights,
+                                      routing=routing, probe=probe)
+            self.scheduler = Scheduler(max_workers=pool_size * len(url), retries=retries)
+        else:
+            self.transport = Transport(url, pool_size=pool_size, compress=compress, timeout=timeout)
+            self.scheduler = Scheduler(max_workers=pool_size, retries=retries)
+        self.lookup_chunk_size = lookup_chunk_size
+        if lookup_cache_size:
+            self.lookup_cache = LookupCache(lookup_cache_size, lookup_cache_ttl)
+        if response_cache:
+            self.response_cache = ResponseCache() if response_cache is True else response_cache
+        if journal:
+            from .journal import Journal
+            self.journal = Journal(journal) if isinstance(journal, str) else journal
+        self._lock = threading.Lock()
+
+        # callbacks receiving the event dict of each request, see request
+        self.before_request = []
+        self.after_request = []
+        if metrics:
+            self.metrics = Metrics() if metrics is True else metrics
+            self.after_request.append(self.metrics.observe)
+
+        if data_model:
+            if isinstance(data_model, str):
+                self._data_model_source = data_model
+            else:
+                self._data_model = data_model
+                if self.metrics:
+                    data_model.metrics = self.metrics
+
+        if check_credentials == 'deferred':
+            self._check_credentials_pending = True
+        elif check_credentials:
+            self.check_credentials()
+
+    @property
+    def data_model(self):
+        """
+        DataModel, loaded on first access.
+        """
+        if self._data_model is None and self._data_model_source:
+            with self._lock:
+                if self._data_model is None:
+                    from .datamodel import DataModel
+                    data_model = DataModel(self._data_model_source)
+                    data_model.metrics = self.metrics
+                    self._data_model = data_model
+        return self._data_model
+
+    def __getattr__(self, name):
+        """
+        Schemas of the datamodel as attributes, created on first access.
+        """
+        if name.startswith('_') or name == 'data_model':
+            raise AttributeError(name)
+        data_model = self.data_model
+        if data_model is None or name not in data_model.classes:
+            raise AttributeError("'%s' object has no attribute or schema '%s'" % (type(self).__name__, name))
+        schema = Schema(self, name)
+        self.__dict__[name] = schema
+        return schema
+
+    def __dir__(self):
+        names = list(super(Itop, self).__dir__())
+        if self.data_model:
+            names += self.data_model.schemas
+        return names
+
+    def check_credentials(self):
+        """
+        Check user and password on iTop.
+        """
+        self._check_credentials_pending = False
         data = {
             'operation': 'core/check_credentials',
             'user': self.auth_user,
             'password': self.auth_pwd
         }
-        self.request(data)
-
-        if data_model:
-            self.data_model = DataModel(data_model)
-            for schema in self.data_model.schemas:
-                setattr(self, schema, Schema(self, schema))
+        return self.request(data)
 
     def request(self, data, raw_response=False):
         """
-        Generic request to iTop API
+        Generic request to iTop API, through the response cache when enabled.
+
+        Callbacks in before_request and after_request receive an event dict with operation, class and retries (of
+        the scheduler) before the request, plus after it: request_bytes, response_bytes, http_seconds, parse_seconds,
+        seconds (total), cached and error (None or the exception).
+        :param data: Valid Data to iTop
+        :return: Result objects
+        """
+        if not self.before_request and not self.after_request:
+            try:
+                return self.cached_send(data, raw_response)
+            except Exception as e:
+                self.tag_error(e, data)
+                raise
+
+        event = self.start_event(data)
+        try:
+            return self.cached_send(data, raw_response, event)
+        except Exception as e:
+            self.tag_error(e, data)
+            event['error'] = e
+            raise
+        finally:
+            self.finish_event(event)
+
+    @staticmethod
+    def tag_error(error, data):
+        # the scheduler retries creates and stimuli only when they did not reach the server, see is_transient
+        if getattr(error, 'operation', None) is None:
+            error.operation = data.get('operation')
+
+    def start_event(self, data):
+        event = {'operation': data.get('operation'), 'class': data.get('class'),
+                 'retries': self.scheduler.attempt() - 1 if self.scheduler else 0, 'cached': False, 'error': None}
+        for callback in self.before_request:
+            callback(event)
+        event['start'] = time.perf_counter()
+        return event
+
+    def finish_event(self, event):
+        event['seconds'] = time.perf_counter() - event.pop('start')
+        for callback in self.after_request:
+            callback(event)
+
+    def cached_send(self, data, raw_response=False, event=None):
+        operation = data.get('operation')
+        if operation in WRITE_OPERATIONS:
+            return self.write(data, raw_response, event)
+
+        cache = self.response_cache
+        if cache is not None and operation in cache.operations:
+            if event is not None:
+                # send unsets it on a miss
+                event['cached'] = True
+            return cache.fetch(data, raw_response, lambda: self.send(data, raw_response, event))
+        return self.send(data, raw_response, event)
+
+    def write(self, data, raw_response=False, event=None):
+        """
+        Write request, skipped when the journal recorded it as done. Cached responses of the class are invalidated.
+        Inside a batch, the write is queued instead.
+        """
+        batch = self.active_batch()
+        if batch is not None:
+            return batch.add(data, raw_response)
+
+        journal = self.journal
+        if journal is not None:
+            key, output = journal.acquire(data, raw_response)
+            if output is not None:
+                if event is not None:
+                    event['journaled'] = True
+                return output
+
+        try:
+            output = self.send(data, raw_response, event)
+        except Exception:
+            if journal is not None:
+                journal.release(key)
+            raise
+        finally:
+            if self.response_cache is not None:
+                self.response_cache.invalidate(self.related_schemas(data.get('class')))
+
+        if journal is not None:
+            journal.record(key, data, output)
+        return output
+
+    def related_schemas(self, name):
+        """
+        Schemas whose objects may change when an object of schema name is written: the schema, its parents and
+        subclasses when there is a datamodel.
+        """
+        if not name:
+            return []
+        data_model = self.data_model
+        if data_model is None:
+            return [name]
+        return [name] + data_model.ancestors(name) + data_model.subclasses(name)
+
+    def send(self, data, raw_response=False, event=None):
+        """
+        Request to iTop API, without cache.
         :param data: Valid Data to iTop
+        :param event: Optional. dict filled with sizes and timings, see request.
         :return: Result objects
         """
-        json_data = json.dumps(data)
+        if self._check_credentials_pending:
+            self.check_credentials()
+
+        json_data = codec.dumps(data)
 
         try:
-            response = requests.post(
-                self.url,
+            start = time.perf_counter()
+            response = self.transport.post(
                 data={
                     'version': self.version,
                     'auth_user': self.auth_user,
@@ -50,35 +267,138 @@ class Itop(object):
                     'json_data': json_data
                 }
             )
-            json_return = json.loads(response.content.decode('utf-8'))
-            return_code = json_return['code']
+            if event is not None:
+                parsed = time.perf_counter()
+                event.update(cached=False, request_bytes=len(json_data), response_bytes=len(response.content),
+                             status=response.status_code, http_seconds=parsed - start)
             response.raise_for_status()
+            json_return = codec.loads(response.content)
+            if event is not None:
+                event['parse_seconds'] = time.perf_counter() - parsed
+            return_code = json_return['code']
         except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema) as e:
-            raise type(e)('Connection adapters (http:// or https://) is invalid: %s. ' % self.url + str(e.message))
+            raise type(e)('Connection adapters (http:// or https://) is invalid: %s. ' % self.url + str(e))
         except requests.exceptions.ConnectionError as e:
             raise type(e)('Connection refused. ' + str(e))
         except requests.exceptions.HTTPError as e:
-            raise type(e)("Could not connect. HTTP code %s. " % response.status_code + str(e))
+            raise type(e)("Could not connect. HTTP code %s. " % response.status_code + str(e), response=response)
         except ValueError as e:
             e.msg = e.msg
             raise type(e)('Not a valid JSON, maybe the page is returning other data: ' + str(e.msg), "", 0)
 
-        if return_code is not 0:
-            raise ItopError(response=response)
+        if return_code != 0:
+            raise ItopError(response=response, json_return=json_return)
 
         if 'objects' not in json_return or json_return['objects'] is None:
-            return []
+            output = []
+        elif raw_response:
+            output = json_return['objects']
+        else:
+            output = codec.clean_objects(json_return['objects'])
 
-        if raw_response:
-            return json_return['objects']
+        if event is not None:
+            event['parse_seconds'] = time.perf_counter() - parsed
+        return output
 
-        clean_objects = list(json_return['objects'].values()) if 'objects' in json_return else []
-        clean_objects = [{**obj['fields'], **{'id': obj['key']}} for obj in clean_objects]
+    def request_stream(self, data, chunk_size=65536):
+        """
+        Generic request to iTop API, reading the response incrementally.
+        Objects are yielded while the response is received, so memory does not grow with the number of objects.
+        An error code is raised as ItopError when the response ends.
+        :param data: Valid Data to iTop
+        :param chunk_size: Optional. Bytes read from the connection at a time.
+        :return: generator of result objects
+        """
+        if self._check_credentials_pending:
+            self.check_credentials()
 
-        if 'output_fields' in data:
-            if len(data['output_fields'].split(', ')) > 1 and data['output_fields'] != '*':
-                clean_objects = []
-        return clean_objects
+        event = self.start_event(data) if self.before_request or self.after_request else None
+        try:
+            yield from self.send_stream(data, chunk_size, event)
+        except Exception as e:
+            if event is not None:
+                event['error'] = e
+            raise
+        finally:
+            if event is not None:
+                # parse_seconds includes the time the caller spends on each object
+                event['parse_seconds'] = time.perf_counter() - event['start'] - event.get('http_seconds', 0.0)
+                self.finish_event(event)
+
+    def send_stream(self, data, chunk_size=65536, event=None):
+        json_data = codec.dumps(data)
+
+        try:
+            start = time.perf_counter()
+            response = self.transport.post(
+                data={
+                    'version': self.version,
+                    'auth_user': self.auth_user,
+                    'auth_pwd': self.auth_pwd,
+                    'json_data': json_data
+                },
+                stream=True
+            )
+            if event is not None:
+                event.update(request_bytes=len(json_data), response_bytes=0, status=response.status_code,
+                             http_seconds=time.perf_counter() - start)
+            response.raise_for_status()
+        except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema) as e:
+            raise type(e)('Connection adapters (http:// or https://) is invalid: %s. ' % self.url + str(e))
+        except requests.exceptions.ConnectionError as e:
+            raise type(e)('Connection refused. ' + str(e))
+        except requests.exceptions.HTTPError as e:
+            response.close()
+            raise type(e)("Could not connect. HTTP code %s. " % response.status_code + str(e), response=response)
+
+        def chunks():
+            for chunk in response.iter_content(chunk_size):
+                if event is not None:
+                    event['response_bytes'] += len(chunk)
+                yield chunk
+
+        header = {}
+        try:
+            for obj in codec.iter_objects(chunks(), header):
+                fields = obj['fields'] if obj.get('fields') is not None else {}
+                fields['id'] = obj['key']
+                yield fields
+        except ValueError as e:
+            raise type(e)('Not a valid JSON, maybe the page is returning other data: ' + str(e.msg), "", 0)
+        finally:
+            response.close()
+
+        if header.get('code') != 0:
+            raise ItopError(response=response, json_return=header)
+
+    def batch(self, comment=None, workers=10):
+        """
+        Defer writes until the block ends, then send them in parallel with the scheduler. Every write carries the
+        same comment and repeated updates of an object are merged into one request. Inside the block, write methods
+        return empty results and iTop errors are raised at the end as BatchError. update with upsert and sync without
+        diff raise ValueError inside the block, use sync(diff=True).
+        If the block raises, queued writes are discarded. Only writes of the current thread, and of the parallel
+        methods it calls, are batched.
+
+            with itop.batch(comment='Nightly sync') as batch:
+                itop.Person.update({'id': 1}, {'phone': '1234'})
+                itop.Person.update({'id': 1}, {'email': 'a@b.c'})
+            batch.results
+
+        :param comment: Optional. Comment of every write.
+        :param workers: Optional. Parallel requests of the flush. default is 10.
+        :return: Batch context manager
+        """
+        return Batch(self, comment, workers)
+
+    def active_batch(self):
+        """
+        :return: Batch open on this Itop in the current thread, or None
+        """
+        for batch in BATCHES.get():
+            if batch.itop is self:
+                return batch
+        return None
 
     def schema(self, name):
         """
@@ -87,3 +407,19 @@ class Itop(object):
         :return: Schema object
         """
         return Schema(self, name)
+
+    def stats(self):
+        """
+        Connection pool reuse statistics.
+        :return: dict with requests, connections and reused counts, plus endpoints when url is a list
+        """
+        return self.transport.stats()
+
+    def close(self):
+        """
+        Close pooled connections, scheduler threads and the journal.
+        """
+        self.scheduler.shutdown()
+        self.transport.close()
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import threading
+import time
+
+
+class Journal(object):
+    def __init__(self, path):
+        """
+        Write-ahead journal of completed core/create, core/update, core/delete and core/apply_stimulus requests,
+        stored in sqlite. Each completed write is recorded with the hash of its payload and the returned objects, so
+        a rerun of an interrupted job skips what was done and returns the recorded objects instead.
+
+        Identical payloads are counted: a job sending the same create three times sends it three times, and a rerun
+        skips as many as were completed. Use one journal per job and remove it (clear) when the job is done,
+        otherwise later identical writes are skipped too.
+        :param path: sqlite file
+        """
+        import sqlite3
+        self.path = path
+        self.skipped = self.recorded = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS writes (key TEXT PRIMARY KEY, operation TEXT, class TEXT, '
+                         'ids TEXT, result TEXT, created REAL)')
+        self._lock = threading.Lock()
+        self._next = {}  # digest = next occurrence
+        self._free = {}  # digest = occurrences released by failed writes
+
+    @staticmethod
+    def digest(data, raw_response=False):
+        payload = json.dumps([data, raw_response], sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def acquire(self, data, raw_response=False):
+        """
+        Key of a write: the payload hash and its occurrence in this job.
+        :return: (key, recorded result or None)
+        """
+        digest = self.digest(data, raw_response)
+        with self._lock:
+            free = self._free.get(digest)
+            if free:
+                occurrence = min(free)
+                free.remove(occurrence)
+            else:
+                occurrence = self._next.get(digest, 0)
+                self._next[digest] = occurrence + 1
+            key = '%s:%d' % (digest, occurrence)
+            row = self._db.execute('SELECT result FROM writes WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.skipped += 1
+                return key, json.loads(row[0])
+        return key, None
+
+    def release(self, key):
+        """
+        Give back the occurrence of a failed write, so its retry gets the same key.
+        """
+        digest, occurrence = key.rsplit(':', 1)
+        with self._lock:
+            self._free.setdefault(digest, set()).add(int(occurrence))
+
+    def record(self, key, data, output):
+        ids = [obj.get('id') for obj in output if isinstance(obj, dict)] if isinstance(output, list) else []
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, data.get('operation'), data.get('class'), json.dumps(ids),
+                              json.dumps(output, default=str), time.time()))
+            self.recorded += 1
+
+    def clear(self):
+        """
+        Forget every recorded write, when the job is done.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM writes')
+            self._next.clear()
+            self._free.clear()
+
+    def stats(self):
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM writes').fetchone()[0]
+            return {'size': size, 'recorded': self.recorded, 'skipped': self.skipped}
+
+    def close(self):
+        self._db.close()
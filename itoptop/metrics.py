@@ -0,0 +1,177 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('itoptop')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total, output = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            output.append((bound, total))
+        return output
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': dict(self.cumulative())}
+
+
+class Metrics(object):
+    def __init__(self, buckets=BUCKETS, slow=None):
+        """
+        Counters and latency histograms of requests by operation and class, and of spans (lookups, datamodel).
+        Register it on Itop with metrics=, or call observe with the events of Itop.after_request.
+        :param buckets: Optional. Upper bounds in seconds of the histogram buckets.
+        :param slow: Optional. Requests slower than these seconds are logged as warnings on the 'itoptop' logger.
+        """
+        self.buckets = buckets
+        self.slow = slow
+        self.requests = {}  # (operation, class) = dict of counters and histograms
+        self.spans = {}  # (name, class) = Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, event):
+        """
+        Account a request event, see Itop.after_request.
+        """
+        key = (event.get('operation'), event.get('class'))
+        with self._lock:
+            item = self.requests.get(key)
+            if item is None:
+                item = self.requests[key] = {
+                    'requests': 0, 'errors': 0, 'cached': 0, 'retries': 0, 'request_bytes': 0,
+                    'response_bytes': 0, 'seconds': Histogram(self.buckets), 'http_seconds': Histogram(self.buckets),
+                    'parse_seconds': Histogram(self.buckets)
+                }
+            item['requests'] += 1
+            item['errors'] += event.get('error') is not None
+            item['cached'] += bool(event.get('cached'))
+            item['retries'] += bool(event.get('retries'))
+            item['request_bytes'] += event.get('request_bytes', 0)
+            item['response_bytes'] += event.get('response_bytes', 0)
+            item['seconds'].observe(event['seconds'])
+            if not event.get('cached') and not event.get('journaled'):
+                item['http_seconds'].observe(event.get('http_seconds', 0.0))
+                item['parse_seconds'].observe(event.get('parse_seconds', 0.0))
+
+        if self.slow is not None and event['seconds'] >= self.slow:
+            logger.warning('Slow iTop request: %s %s %.3fs (http %.3fs, parse %.3fs, %d bytes sent, '
+                           '%d bytes received, %d retries)', key[0], key[1], event['seconds'],
+                           event.get('http_seconds', 0.0), event.get('parse_seconds', 0.0),
+                           event.get('request_bytes', 0), event.get('response_bytes', 0), event.get('retries', 0))
+
+    def observe_span(self, name, schema, seconds):
+        with self._lock:
+            histogram = self.spans.get((name, schema))
+            if histogram is None:
+                histogram = self.spans[(name, schema)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name, schema=None):
+        """
+        Time a block as span name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_span(name, schema, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        :return: dict with 'requests' index by operation and class, and 'spans' index by name and class
+        """
+        with self._lock:
+            requests = {}
+            for (operation, schema), item in self.requests.items():
+                requests.setdefault(operation, {})[schema] = {
+                    k: v.snapshot() if isinstance(v, Histogram) else v for k, v in item.items()}
+            spans = {}
+            for (name, schema), histogram in self.spans.items():
+                spans.setdefault(name, {})[schema] = histogram.snapshot()
+            return {'requests': requests, 'spans': spans}
+
+    def prometheus(self):
+        """
+        :return: metrics in Prometheus text exposition format
+        """
+        def labels(**values):
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in values.items() if v is not None)
+
+        def histogram(lines, name, histogram, **values):
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{%s} %d' % (name, labels(le=repr(bound), **values), count))
+            lines.append('%s_bucket{%s} %d' % (name, labels(le='+Inf', **values), histogram.count))
+            lines.append('%s_sum{%s} %r' % (name, labels(**values), histogram.sum))
+            lines.append('%s_count{%s} %d' % (name, labels(**values), histogram.count))
+
+        counters = (('requests', 'Requests'), ('errors', 'Failed requests'),
+                    ('cached', 'Requests answered by the response cache'),
+                    ('retries', 'Requests retried by the scheduler'), ('request_bytes', 'Bytes of request json'),
+                    ('response_bytes', 'Bytes of responses'))
+        histograms = (('seconds', 'Request duration'), ('http_seconds', 'HTTP duration, until the response is read'),
+                      ('parse_seconds', 'Response parsing duration'))
+        lines = []
+        with self._lock:
+            for counter, description in counters:
+                name = 'itoptop_%s_total' % counter
+                lines += ['# HELP %s %s.' % (name, description), '# TYPE %s counter' % name]
+                for (operation, schema), item in sorted(self.requests.items(), key=str):
+                    lines.append('%s{%s} %d' % (name, labels(operation=operation, **{'class': schema}),
+                                                item[counter]))
+            for field, description in histograms:
+                name = 'itoptop_request_%s' % field
+                lines += ['# HELP %s %s.' % (name, description), '# TYPE %s histogram' % name]
+                for (operation, schema), item in sorted(self.requests.items(), key=str):
+                    histogram(lines, name, item[field], operation=operation, **{'class': schema})
+            name = 'itoptop_span_seconds'
+            lines += ['# HELP %s Duration of lookups and datamodel spans.' % name, '# TYPE %s histogram' % name]
+            for (span, schema), item in sorted(self.spans.items(), key=str):
+                histogram(lines, name, item, span=span, **{'class': schema})
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.spans.clear()
+
+
+def timed(name):
+    """
+    Decorator recording a method call as span name, when metrics are enabled. The class label is the schema name
+    for Schema methods, else the first argument.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = getattr(self, 'metrics', None) or getattr(getattr(self, 'itop', None), 'metrics', None)
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            schema = getattr(self, 'name', None) or (args[0] if args else None)
+            with metrics.span(name, schema):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
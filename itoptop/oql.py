@@ -0,0 +1,111 @@
+"""
+Mongo-style query compiler to OQL conditions.
+
+    {'name': 'A'}                                   name = "A"
+    {'name': ['A', 'B']}                            name IN ("A", "B")
+    {'id': {'$in': [1, 2]}}                         id IN (1, 2)
+    {'status': {'$ne': 'closed'}}                   status != "closed"
+    {'start_date': {'$gte': '2018-01-01'}}          start_date >= "2018-01-01"
+    {'name': {'$like': 'srv%'}}                     name LIKE "srv%"
+    {'$or': [{'name': 'A'}, {'code': 'A'}]}         (name = "A") OR (code = "A")
+"""
+import re
+
+OPERATORS = {
+    '$eq': '=',
+    '$ne': '!=',
+    '$gt': '>',
+    '$gte': '>=',
+    '$lt': '<',
+    '$lte': '<=',
+    '$like': 'LIKE',
+    '$nlike': 'NOT LIKE',
+    '$in': 'IN',
+    '$nin': 'NOT IN'
+}
+
+FIELD = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(->[A-Za-z_][A-Za-z0-9_]*)*$')
+
+
+def quote(value):
+    """
+    OQL literal of a value. Numbers are kept, everything else is an escaped string.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def field_name(field):
+    if not isinstance(field, str) or not FIELD.match(field):
+        raise ValueError('Invalid field name in query: %r' % (field,))
+    return field
+
+
+def condition(field, operator, value):
+    field = field_name(field)
+    if operator not in OPERATORS:
+        raise ValueError('Unknown query operator %r on field %s' % (operator, field))
+    if operator in ('$in', '$nin'):
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        if not values:
+            return '1 = 0' if operator == '$in' else '1 = 1'
+        return '%s %s (%s)' % (field, OPERATORS[operator], ", ".join(quote(v) for v in values))
+    if value is None and operator in ('$eq', '$ne'):
+        return ('ISNULL(%s)' if operator == '$eq' else 'NOT ISNULL(%s)') % field
+    return '%s %s %s' % (field, OPERATORS[operator], quote(value))
+
+
+def compile(query):
+    """
+    Convert a query object to an OQL condition. Fields are compared with = by default,
+    lists are IN conditions and every field is joined by AND.
+    :param query: dict
+    :return: condition string, empty when query is empty
+    """
+    if not isinstance(query, dict):
+        raise TypeError("Query must be a dict")
+
+    conditions = []
+    for field, value in query.items():
+        if field in ('$or', '$and'):
+            if not isinstance(value, (list, tuple)) or not value:
+                raise ValueError('%s must be a non empty list of queries' % field)
+            parts = ['(%s)' % (compile(q) or '1 = 1') for q in value]
+            conditions.append('(%s)' % (' OR ' if field == '$or' else ' AND ').join(parts))
+        elif isinstance(value, dict):
+            conditions += [condition(field, operator, v) for operator, v in value.items()]
+        elif isinstance(value, (list, tuple, set)):
+            conditions.append(condition(field, '$in', value))
+        else:
+            conditions.append(condition(field, '$eq', value))
+    return " AND ".join(conditions)
+
+
+def split(query, chunk_size=500):
+    """
+    Split the largest IN list of a query, so each query stays under iTop request size limits.
+    :param query: dict
+    :param chunk_size: maximum values of the IN list of each query
+    :return: list of queries
+    """
+    largest, values = None, []
+    for field, value in query.items():
+        if isinstance(value, dict) and isinstance(value.get('$in'), (list, tuple, set)):
+            candidate = list(value['$in'])
+        elif isinstance(value, (list, tuple, set)) and not field.startswith('$'):
+            candidate = list(value)
+        else:
+            continue
+        if len(candidate) > len(values):
+            largest, values = field, candidate
+
+    if largest is None or len(values) <= chunk_size:
+        return [query]
+
+    queries = []
+    for i in range(0, len(values), chunk_size):
+        value = query[largest]
+        chunk = values[i:i + chunk_size]
+        queries.append({**query, largest: {**value, '$in': chunk} if isinstance(value, dict) else chunk})
+    return queries
@@ -1,3 +1,9 @@
+import contextvars
+import random
+import threading
+import time
+
+
 def tmap(fn, args, workers=1):
     """
     Multithread map, wait threads and return results in a list.
@@ -14,4 +20,198 @@ def tmap(fn, args, workers=1):
         res = ex.map(fn, args)
         ex.shutdown(wait=True)
 
-    return list(res)
\ No newline at end of file
+    return list(res)
+
+
+NON_IDEMPOTENT = ('core/create', 'core/apply_stimulus')
+
+
+def is_transient(error):
+    """
+    Errors worth a retry: timeouts, refused connections and HTTP 429/5xx. iTop errors are not transient.
+    Creates and stimuli (the operation set on the error by Itop.request) are only retried when they did not reach
+    the server, since after a read timeout or a 5xx iTop may have applied them already.
+    """
+    import requests
+    from .exceptions import ItopError
+    from .transport import connect_failed
+    if isinstance(error, ItopError):
+        return False
+    if getattr(error, 'operation', None) in NON_IDEMPOTENT:
+        return connect_failed(error)
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = getattr(error, 'response', None)
+        return response is not None and (response.status_code == 429 or response.status_code >= 500)
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class Result(object):
+    __slots__ = ('value', 'error', 'attempts')
+
+    def __init__(self, value=None, error=None, attempts=0):
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+
+    def __repr__(self):
+        return 'Result(value=%r, error=%r, attempts=%d)' % (self.value, self.error, self.attempts)
+
+
+class Scheduler(object):
+    def __init__(self, max_workers=10, min_workers=1, retries=3, backoff=0.5, max_backoff=30, latency_factor=4.0,
+                 transient=is_transient):
+        """
+        Long-lived request scheduler. Threads are reused between calls and the number of concurrent requests
+        adapts AIMD-style: it grows by one per window of successes and halves on timeouts, HTTP 5xx or latency above
+        latency_factor times the best observed latency.
+        :param max_workers: Maximum concurrent requests, also the number of threads.
+        :param min_workers: Minimum concurrent requests.
+        :param retries: Retries of a transient failure before giving up the item.
+        :param backoff: Base seconds of the jittered exponential backoff.
+        :param max_backoff: Maximum seconds between retries.
+        :param latency_factor: Latency, relative to the best one, seen as server overload. None disables it.
+        :param transient: function that tells if an exception is worth a retry.
+        """
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.latency_factor = latency_factor
+        self.transient = transient
+
+        self.limit = float(max_workers)
+        self.inflight = 0
+        self.latency = None
+        self.base_latency = None
+        self.successes = self.failures = self.retried = 0
+
+        self._executor = None
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def _get_executor(self):
+        with self._condition:
+            if self._executor is None:
+                import concurrent.futures
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers,
+                                                                       thread_name_prefix='itoptop')
+            return self._executor
+
+    def _acquire(self):
+        with self._condition:
+            while self.inflight >= max(int(self.limit), self.min_workers):
+                self._condition.wait()
+            self.inflight += 1
+
+    def _release(self, latency=None, congested=False):
+        with self._condition:
+            self.inflight -= 1
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                self.base_latency = latency if self.base_latency is None else min(self.base_latency, self.latency)
+                if self.latency_factor and self.latency > self.base_latency * self.latency_factor:
+                    congested = True
+            if congested:
+                self.limit = max(self.limit / 2, float(self.min_workers))
+            elif latency is not None:
+                self.limit = min(self.limit + 1 / self.limit, float(self.max_workers))
+            self._condition.notify_all()
+
+    def call(self, fn, arg):
+        """
+        Call fn(arg) in the current thread, with admission control and retries.
+        :return: Result
+        """
+        inline = getattr(self._local, 'active', False)
+        outer_attempt = getattr(self._local, 'attempt', 1)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not inline:
+                self._acquire()
+            start = time.monotonic()
+            self._local.attempt = attempt
+            try:
+                value = fn(arg)
+            except Exception as e:
+                self._local.attempt = outer_attempt
+                transient = self.transient(e)
+                if not inline:
+                    self._release(congested=transient)
+                if transient and attempt <= self.retries:
+                    with self._condition:
+                        self.retried += 1
+                    time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))))
+                    continue
+                with self._condition:
+                    self.failures += 1
+                return Result(error=e, attempts=attempt)
+            self._local.attempt = outer_attempt
+            if not inline:
+                self._release(latency=time.monotonic() - start)
+            with self._condition:
+                self.successes += 1
+            return Result(value=value, attempts=attempt)
+
+    def attempt(self):
+        """
+        :return: attempt number of the call running in the current thread, 1 outside of a call
+        """
+        return getattr(self._local, 'attempt', 1)
+
+    def map(self, fn, args, workers=None):
+        """
+        Apply fn to every arg, collecting each result or error instead of stopping on the first failure.
+        Calls made from inside a scheduled function run serially in the calling thread. Worker threads run fn in a
+        copy of the caller's context variables (e.g. the active Itop.batch).
+        :param fn: function
+        :param args: list
+        :param workers: Optional. Maximum concurrent calls of this map, bounded by the scheduler limit.
+        :return: list of Result, in the order of args
+        """
+        args = list(args)
+
+        def fn_inline(arg):
+            active = getattr(self._local, 'active', False)
+            self._local.active = True
+            try:
+                return fn(arg)
+            finally:
+                self._local.active = active
+
+        if getattr(self._local, 'active', False) or workers == 1 or len(args) <= 1:
+            return [self.call(fn_inline, arg) for arg in args]
+
+        gate = threading.BoundedSemaphore(workers) if workers else None
+        context = contextvars.copy_context()
+
+        def task(arg):
+            if gate:
+                gate.acquire()
+            try:
+                result = context.copy().run(self.call, fn_inline, arg)
+            finally:
+                if gate:
+                    gate.release()
+            return result
+
+        executor = self._get_executor()
+        return [future.result() for future in [executor.submit(task, arg) for arg in args]]
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'inflight': self.inflight,
+                'latency': self.latency,
+                'successes': self.successes,
+                'failures': self.failures,
+                'retried': self.retried
+            }
+
+    def shutdown(self):
+        with self._condition:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,234 @@
+"""
+Column-wise storage of objects. Each column is dictionary encoded: its distinct values are kept once and every row
+holds a small integer code, so large results take a fraction of the memory of one dict per object.
+NumPy, pandas and pyarrow are used when installed.
+"""
+import sys
+from array import array
+
+WIDTHS = (('B', 2 ** 8), ('H', 2 ** 16), ('I', 2 ** 32))
+
+
+def _numpy():
+    """
+    NumPy is imported on first use so importing itoptop does not load it.
+    :return: numpy module or None when not installed
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class Column(object):
+    __slots__ = ('values', 'codes', '_index')
+
+    def __init__(self, size=0):
+        self.values = [None]  # code 0 is a missing value
+        self.codes = array('B', bytes(size))
+        self._index = {}
+
+    def code(self, value):
+        if isinstance(value, (list, dict)):
+            # linked sets are not hashable, each one is a distinct value
+            self.values.append(value)
+            self._widen()
+            return len(self.values) - 1
+
+        index = self._index
+        if index is None:
+            index = self._index = {value: code for code, value in enumerate(self.values)
+                                   if code and not isinstance(value, (list, dict))}
+        code = index.get(value)
+        if code is None:
+            if isinstance(value, str):
+                value = sys.intern(value)
+            code = index[value] = len(self.values)
+            self.values.append(value)
+            self._widen()
+        return code
+
+    def _widen(self):
+        for typecode, limit in WIDTHS:
+            if len(self.values) <= limit:
+                if self.codes.typecode != typecode:
+                    self.codes = array(typecode, self.codes)
+                return
+
+    def freeze(self):
+        self._index = None
+
+
+class ResultSet(object):
+    def __init__(self, objs=None):
+        """
+        Objects stored by column. Iterating yields dicts built on demand.
+        :param objs: Optional. iterable of objects (dicts), consumed one at a time.
+        """
+        self.fields = []
+        self.columns = {}
+        self.size = 0
+        if objs is not None:
+            self.extend(objs)
+
+    def extend(self, objs):
+        columns = self.columns
+        for obj in objs:
+            for field in obj:
+                if field not in columns:
+                    field = sys.intern(field)
+                    self.fields.append(field)
+                    columns[field] = Column(self.size)
+            for field, column in columns.items():
+                value = obj.get(field)
+                code = 0 if value is None else column.code(value)  # may widen column.codes
+                column.codes.append(code)
+            self.size += 1
+        for column in columns.values():
+            column.freeze()
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return 'ResultSet(%d objects, fields=%r)' % (self.size, self.fields)
+
+    def __iter__(self):
+        items = [(field, column.values, column.codes) for field, column in self.columns.items()]
+        for row in range(self.size):
+            yield {field: values[codes[row]] for field, values, codes in items if codes[row]}
+
+    def __getitem__(self, item):
+        """
+        :param item: row number, slice or field name
+        :return: dict, ResultSet or list of the column values
+        """
+        if isinstance(item, str):
+            return self.column(item)
+        if isinstance(item, slice):
+            return self.take(range(self.size)[item])
+        if item < 0:
+            item += self.size
+        if not 0 <= item < self.size:
+            raise IndexError('ResultSet index out of range')
+        return {field: column.values[column.codes[item]] for field, column in self.columns.items()
+                if column.codes[item]}
+
+    def column(self, field):
+        """
+        :return: list of the field values, None where missing
+        """
+        column = self.columns[field]
+        values = column.values
+        return [values[code] for code in column.codes]
+
+    def take(self, rows):
+        """
+        :param rows: row numbers
+        :return: ResultSet of these rows, sharing the distinct values
+        """
+        output = ResultSet()
+        output.fields = list(self.fields)
+        numpy = _numpy()
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.intp)
+        for field, column in self.columns.items():
+            selected = Column()
+            selected.values = column.values
+            selected.freeze()
+            if numpy is not None:
+                selected.codes = array(column.codes.typecode)
+                if len(rows):
+                    selected.codes.frombytes(numpy.frombuffer(column.codes, column.codes.typecode)[rows].tobytes())
+            else:
+                codes = column.codes
+                selected.codes = array(codes.typecode, [codes[row] for row in rows])
+            output.columns[field] = selected
+        output.size = len(rows)
+        return output
+
+    def filter(self, predicate=None, **conditions):
+        """
+        Select rows. Conditions are tested once per distinct value of a column, not once per row.
+            results.filter(status='production', org_id=['1', '2'], name=lambda name: name.startswith('srv'))
+        :param predicate: Optional. Function receiving each row as a dict, slower than conditions.
+        :param conditions: field = value, list of accepted values or function receiving the value. None matches
+            missing values.
+        :return: ResultSet
+        """
+        rows = None
+        for field, condition in conditions.items():
+            column = self.columns.get(field)
+            if column is None:
+                accepted = set()
+            else:
+                if callable(condition):
+                    # missing values are not passed to functions
+                    test = lambda value, condition=condition: value is not None and condition(value)
+                elif isinstance(condition, (list, tuple, set)):
+                    test = lambda value, accepted=condition: value in accepted
+                else:
+                    test = lambda value, accepted=condition: value == accepted
+                accepted = set(code for code, value in enumerate(column.values) if test(value))
+            rows = self._rows(column, accepted, rows)
+
+        if predicate is not None:
+            rows = range(self.size) if rows is None else rows
+            rows = [row for row, obj in zip(rows, self.take(rows)) if predicate(obj)]
+        return self.take(range(self.size) if rows is None else rows)
+
+    def _rows(self, column, accepted, rows):
+        if column is None or not accepted:
+            return []
+        numpy = _numpy()
+        if numpy is not None:
+            codes = numpy.frombuffer(column.codes, column.codes.typecode)
+            mask = numpy.isin(codes, numpy.fromiter(accepted, dtype=codes.dtype, count=len(accepted)))
+            selected = numpy.flatnonzero(mask)
+            return selected if rows is None else numpy.intersect1d(rows, selected, assume_unique=True)
+        codes = column.codes
+        candidates = range(self.size) if rows is None else rows
+        return [row for row in candidates if codes[row] in accepted]
+
+    def to_records(self):
+        """
+        :return: list of dicts
+        """
+        return list(self)
+
+    def to_columns(self):
+        """
+        :return: dict index by field = list of values
+        """
+        return {field: self.column(field) for field in self.fields}
+
+    def to_pandas(self):
+        """
+        DataFrame with categorical columns built from the codes.
+        """
+        import numpy
+        import pandas
+        data = {}
+        for field, column in self.columns.items():
+            if any(isinstance(value, (list, dict)) for value in column.values):
+                data[field] = self.column(field)
+            else:
+                codes = numpy.frombuffer(column.codes, column.codes.typecode).astype('int64') - 1
+                data[field] = pandas.Categorical.from_codes(codes, categories=column.values[1:])
+        return pandas.DataFrame(data, columns=self.fields)
+
+    def to_arrow(self):
+        """
+        pyarrow Table of dictionary arrays.
+        """
+        import pyarrow
+        arrays = []
+        for field, column in self.columns.items():
+            if any(isinstance(value, (list, dict)) for value in column.values):
+                arrays.append(pyarrow.array(self.column(field)))
+                continue
+            indices = pyarrow.array([code - 1 if code else None for code in column.codes], type=pyarrow.int32())
+            arrays.append(pyarrow.DictionaryArray.from_arrays(indices, pyarrow.array(column.values[1:])))
+        return pyarrow.Table.from_arrays(arrays, names=self.fields)
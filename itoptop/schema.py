@@ -1,33 +1,70 @@
-from .exceptions import ItopError
-from .parallel import tmap
+from . import oql
+from .exceptions import BatchError, ItopError
+from .metrics import timed
+from .parallel import Result, tmap
+from .resultset import ResultSet
 
 
-class Schema(object):
+class BaseSchema(object):
+    """
+    Request building helpers shared by Schema and AsyncSchema, without any request.
+    """
+
     def __init__(self, itop, name):
         self.itop = itop
         self.name = name
 
     def to_oql(self, query):
         """
-        Convert a query object to OQL WHERE clause.
+        Convert a query object to OQL WHERE clause. See oql.compile for operators, fields are compared with = by
+        default and values are escaped.
         :param query: Specifies selection filter.
-        :return: oql string with WHERE clause specified by filter.
+        :return: oql string with WHERE clause specified by filter, or the id when query is only a scalar id.
         """
-        if 'id' in query:
+        if len(query) == 1 and 'id' in query and not isinstance(query['id'], (dict, list, tuple, set)):
             return query['id']
 
-        oql = "SELECT %s " % self.name
-        if len(query):
-            oql += "WHERE " + " AND ".join(['%s LIKE "%s"' % (k, query[k]) for k in query])
-        return oql
+        where = oql.compile(query)
+        return "SELECT %s WHERE %s" % (self.name, where) if where else "SELECT %s" % self.name
+
+    def split_query(self, query):
+        """
+        Split a query with a large IN list in several queries of at most itop lookup_chunk_size values.
+        """
+        return oql.split(query, getattr(self.itop, 'lookup_chunk_size', 500))
+
+    @staticmethod
+    def to_output_fields(projection):
+        """
+        Convert a projection list to iTop output_fields, so only the projected fields are sent by the server.
+        The object key is always returned as id, so at least the friendlyname is requested when only id is projected.
+        :param projection: list of fields
+        :return: output_fields string
+        """
+        if not projection:
+            return "*+"
+        fields = [field for field in projection if field != 'id']
+        return ",".join(fields) if fields else "friendlyname"
+
+    @staticmethod
+    def clean(obj):
+        """
+        Reserved words starts with '_' so remove this, and remove empty fields.
+        """
+        return {(k[1:] if k.startswith('_') else k): v for k, v in obj.items() if v}
 
-    def find(self, query=None, projection=None, limit='0',page='1'):    # added pagination parameters limit and page
+
+class Schema(BaseSchema):
+    # added pagination parameters limit and page
+    def find(self, query=None, projection=None, limit='0',page='1', as_columns=False):
         """
         Selects objects in a schema.
         :param query: Optional. Specifies selection filter. To return all objects in a schema,
             omit this parameter or pass an empty object ({}).
         :param projection: Optional. Specifies the fields to return in the objects that match the query filter.
             To return all fields in the matching objects, omit this parameter.
+        :param as_columns: Optional. If set to true, returns a ResultSet storing the objects by column, even for one
+            object. Without limit, pages are read with iter_find and encoded as they arrive.
         :return:
         """
         query = query if query else {}
@@ -38,27 +75,30 @@ class Schema(object):
         if not isinstance(projection, list):
             raise TypeError("Projection must be a list")
 
-        '''projection will be used to parse returned dans for all fields on line 60
-        if len(projection):
-            output_fields = ",".join(projection)
-        else:
-            output_fields = "*+"
-        '''
-        output_fields = "*+"
+        if as_columns and str(limit) == '0':
+            return ResultSet(self.iter_find(query, projection))
 
-        key = self.to_oql(query)
+        output_fields = self.to_output_fields(projection)
 
-        data = {
-            'operation': 'core/get',
-            'comment': 'Get ' + self.name,
-            'class': self.name,
-            'key': key,
-            'output_fields': output_fields,
-            'limit': limit,
-            'page': page
-        }
+        # large IN lists are split in several requests, unless a page is requested
+        queries = self.split_query(query) if str(limit) == '0' else [query]
+
+        response = []
+        for query in queries:
+            data = {
+                'operation': 'core/get',
+                'comment': 'Get ' + self.name,
+                'class': self.name,
+                'key': self.to_oql(query),
+                'output_fields': output_fields,
+                'limit': limit,
+                'page': page
+            }
+            response += self.itop.request(data)
 
-        response = self.itop.request(data)
+        if as_columns:
+            return ResultSet({k: v for k, v in obj.items() if k in projection} if projection else obj
+                             for obj in response)
 
         if projection:
             output = [{k: v for k, v in obj.items() if k in projection} for obj in response]
@@ -73,7 +113,153 @@ class Schema(object):
 
         return output
 
-    def find_related(self, query=None, relation='impacts', depth=20, direction='down'):
+    def iter_find(self, query=None, projection=None, page_size=1000, prefetch=True, stream=False):
+        """
+        Iterate over objects in a schema, requesting one page at a time.
+        :param query: Optional. Specifies selection filter.
+        :param projection: Optional. Specifies the fields to return in the objects that match the query filter.
+        :param page_size: Optional. Number of objects requested per page. default is 1000.
+            With stream, 0 requests all objects at once.
+        :param prefetch: Optional. If set to true, the next page is requested in background while the current one
+            is consumed. default is true. Ignored with stream.
+        :param stream: Optional. If set to true, each response is parsed incrementally with Itop.request_stream,
+            yielding objects while they are received.
+        :return: generator of objects
+        """
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        projection = projection if projection else []
+        if not isinstance(projection, list):
+            raise TypeError("Projection must be a list")
+
+        if int(page_size) < 1 and not (stream and int(page_size) == 0):
+            raise ValueError("Page size must be greater than 0")
+
+        output_fields = self.to_output_fields(projection)
+
+        def page_data(key, page):
+            return {
+                'operation': 'core/get',
+                'comment': 'Get ' + self.name,
+                'class': self.name,
+                'key': key,
+                'output_fields': output_fields,
+                'limit': str(page_size),
+                'page': str(page)
+            }
+
+        for key in [self.to_oql(query) for query in self.split_query(query)]:
+            if stream:
+                page = 1
+                while True:
+                    count = 0
+                    for obj in self.itop.request_stream(page_data(key, page)):
+                        count += 1
+                        yield {k: v for k, v in obj.items() if k in projection} if projection else obj
+                    if not page_size or count < page_size:
+                        break
+                    page += 1
+                continue
+
+            def get_page(page):
+                return self.itop.request(page_data(key, page))
+
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(1) as ex:
+                page = 1
+                future = ex.submit(get_page, page)
+                while future:
+                    objs = future.result()
+                    page += 1
+                    last = len(objs) < page_size
+                    future = None
+                    if not last and prefetch:
+                        future = ex.submit(get_page, page)
+
+                    for obj in objs:
+                        yield {k: v for k, v in obj.items() if k in projection} if projection else obj
+                    del objs
+
+                    if not last and not prefetch:
+                        future = ex.submit(get_page, page)
+
+    def max_id(self, query=None):
+        """
+        Highest id of the objects that match the query, found with an exponential and binary search of tiny
+        requests since OQL has no ORDER BY.
+        :param query: Optional. Specifies selection filter.
+        :return: int, 0 when no object matches
+        """
+        query = query if query else {}
+
+        def exists_above(value):
+            return bool(self.find({'$and': [query, {'id': {'$gt': value}}]}, ['id'], limit='1'))
+
+        low, high = 0, 1
+        while exists_above(high):
+            low, high = high, high * 2
+        # an object above low exists, none above high
+        if not exists_above(low):
+            return low
+        while high - low > 1:
+            middle = (low + high) // 2
+            if exists_above(middle):
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def changes(self, watermarks, projection=None, page_size=1000, stream=False):
+        """
+        Iterate over objects changed since the last run, found in the CMDBChangeOp history. The first run, without
+        watermark, reads every object. The watermark is saved only when the generator is exhausted, so an interrupted
+        run is read again.
+        :param watermarks: Watermarks, or a dict index by class = last change id read.
+        :param projection: Optional. Specifies the fields to return in the changed objects.
+        :param page_size: Optional. Number of objects requested per page. default is 1000.
+        :param stream: Optional. If set to true, responses are parsed incrementally, see iter_find.
+        :return: generator of ('upsert', obj) and ('delete', {'id': id})
+        """
+        from .changes import CHANGE_CLASS, DELETE_CLASS
+
+        projection = projection + ['id'] if projection and 'id' not in projection else projection
+        history = self.itop.schema(CHANGE_CLASS)
+        watermark = watermarks.get(self.name)
+        if watermark is None:
+            watermark = history.max_id()
+            for obj in self.iter_find({}, projection, page_size=page_size, stream=stream):
+                yield 'upsert', obj
+        else:
+            data_model = self.itop.data_model
+            objclasses = [self.name] + (data_model.subclasses(self.name) if data_model else [])
+            query = {'id': {'$gt': watermark}, 'objclass': objclasses}
+            changed, deleted = {}, set()  # dict keeps the first change order
+            fields = ['id', 'objkey', 'finalclass']
+            for change in history.iter_find(query, fields, page_size=page_size, stream=stream):
+                watermark = max(watermark, int(change['id']))
+                key = str(change['objkey'])
+                if change.get('finalclass') == DELETE_CLASS:
+                    deleted.add(key)
+                else:
+                    changed.setdefault(key)
+
+            found = set()
+            changed = [key for key in changed if key not in deleted]
+            if changed:
+                for obj in self.iter_find({'id': changed}, projection, page_size=page_size, stream=stream):
+                    found.add(str(obj['id']))
+                    yield 'upsert', obj
+            # changed objects not found were deleted or left the class since
+            for key in sorted(deleted | set(changed) - found, key=int):
+                yield 'delete', {'id': key}
+
+        watermarks[self.name] = watermark
+        if hasattr(watermarks, 'save'):
+            watermarks.save()
+
+    def find_related(self, query=None, relation='impacts', depth=20, direction='down', as_columns=False):
         """
         Selects related objects in a schema.
         :param query: Optional. Specifies selection filter. To return all objects in a schema,
@@ -81,6 +267,7 @@ class Schema(object):
         :param relation: Optional. May be 'impacts' or 'depends on'
         :param depth: Optional. Limitation of iteration depth (default 20).
         :param direction: Optional. May be 'up' or 'down'
+        :param as_columns: Optional. If set to true, returns a ResultSet storing the objects by column.
         :return:
         """
         query = query if query else {}
@@ -100,6 +287,9 @@ class Schema(object):
         }
 
         response = self.itop.request(data, raw_response=True)
+        if as_columns:
+            return ResultSet({**obj['fields'], **{'id': obj['key']}, **{'class': obj['class']}}
+                             for obj in response.values())
         clean_objects = list(response.values())
         clean_objects = [{**obj['fields'], **{'id': obj['key']}, **{'class': obj['class']}} for obj in clean_objects]
 
@@ -126,13 +316,11 @@ class Schema(object):
             raise TypeError("Query must be a object or list of objects")
         objs = objs if isinstance(objs, list) else [objs]
 
-        # reserved words starts with '_' so remove this;
-        # remove empty fields
-        clean = lambda k: k[1:] if k[0] == '_' else k
-        objs = [{clean(k): v for k, v in obj.items() if v} for obj in objs]
+        objs = [self.clean(obj) for obj in objs]
 
         if self.itop.data_model:
-            objs = [self.lookup(obj) for obj in objs]
+            resolved = self.resolve_lookups(objs)
+            objs = [self.lookup(obj, resolved) for obj in objs]
 
         datas = [
             {
@@ -144,7 +332,11 @@ class Schema(object):
             } for obj in objs
         ]
 
-        output = tmap(self.itop.request, datas, workers=workers)
+        try:
+            output = self.parallel(self.itop.request, datas, workers=workers)
+        finally:
+            # requests that succeeded before a failure have written
+            self.invalidate_lookups()
         output = [item for result in output for item in result]
 
         #Unified output format to list
@@ -157,7 +349,7 @@ class Schema(object):
         '''
         return output
 
-    def update(self, query, update, upsert=False, multi=False):
+    def update(self, query, update, upsert=False, multi=False, workers=10):
         """
         Modifies an existing object or objects in a schema. The method can modify specific fields of an existing
         object or objects or replace an existing object entirely, depending on the update parameter.
@@ -171,8 +363,9 @@ class Schema(object):
         :param update: The modifications to apply.
         :param upsert: Optional. If set to true, creates a new object when no object matches the query criteria.
             The default value is false, which does not insert a new object when no match is found.
-        :param multi: Optional. If set to true, updates multiple objs that meet the query criteria.
+        :param multi: Optional. If set to true, updates multiple objs that meet the query criteria with update_many.
             If set to false, updates one object. The default value is false.
+        :param workers: Optional. Parallel requests when multi is true. default is 10.
         :return: List of Elements
         """
         query = query if query else {}
@@ -183,10 +376,29 @@ class Schema(object):
         if not isinstance(update, dict):
             raise TypeError("Query must be a dict")
 
+        if upsert and not multi:
+            self.check_upsert()
+
+        if multi:
+            result = self.update_many(query, update, upsert, workers)
+            if result['errors']:
+                raise result['errors'][0][1]
+            output = result['objects']
+            if not output:
+                return {}
+
+            if isinstance(output, list) and len(output) == 1:
+                output = output[0]
+
+            if isinstance(output, dict) and len(output) == 1:
+                _, output = list(output.items())[0]
+
+            return output
+
         key = self.to_oql(query)
 
         if self.itop.data_model:
-            update = self.lookup(update)
+            update = self.lookup(update, self.resolve_lookups([update]))
 
         update_data = {
             'operation': 'core/update',
@@ -198,29 +410,62 @@ class Schema(object):
         }
 
         try:
-            return self.itop.request(update_data)
+            output = self.itop.request(update_data)
+            self.invalidate_lookups()
+            return output
         except ItopError as e:
-            if 'Several items' in str(e):
-                if multi:
-                    objs = self.find(query)
-                    output = tmap(lambda obj: self.update(obj, update, upsert, multi), objs)
-                    output = [item for result in output for item in result]
-
-                    if isinstance(output, list) and len(output) == 1:
-                        output = output[0]
-
-                    if isinstance(output, dict) and len(output) == 1:
-                        _, output = list(output.items())[0]
-
-                    return output
-                raise e
-
             if 'No item found for query' in str(e):
                 if upsert:
                     return self.insert({**query, **update})
                 return {}
             raise e
 
+    def update_many(self, query, update, upsert=False, workers=10):
+        """
+        Updates all objects that match the query. Lookups of the update are resolved once, the ids are fetched with a
+        single query and each object is updated by id in parallel requests.
+        :param query: The selection criteria for the update.
+        :param update: The modifications to apply.
+        :param upsert: Optional. If set to true, creates a new object when no object matches the query criteria.
+        :param workers: Optional. Parallel requests. default is 10.
+        :return: dict with updated objects and errors as a list of (id, exception)
+        """
+        query = query if query else {}
+        if not isinstance(query, dict):
+            raise TypeError("Query must be a dict")
+
+        update = update if update else {}
+        if not isinstance(update, dict):
+            raise TypeError("Query must be a dict")
+
+        ids = [obj['id'] for obj in self.iter_find(query, ['id'])]
+
+        if not ids:
+            if upsert:
+                return {'objects': self.insert({**query, **update}), 'errors': []}
+            return {'objects': [], 'errors': []}
+
+        if self.itop.data_model:
+            update = self.lookup(update, self.resolve_lookups([update]))
+
+        def step(key):
+            return self.itop.request({
+                'operation': 'core/update',
+                'comment': 'Update ' + self.name,
+                'class': self.name,
+                'output_fields': "*",
+                'fields': update,
+                'key': key
+            })
+
+        results = self.map_results(step, ids, workers=workers)
+        self.invalidate_lookups()
+
+        return {
+            'objects': [item for result in results if result.error is None for item in result.value],
+            'errors': [(key, result.error) for key, result in zip(ids, results) if result.error is not None]
+        }
+
     def remove(self, query):
         """
 
@@ -241,6 +486,7 @@ class Schema(object):
             'key': key
         }
         output = self.itop.request(data)
+        self.invalidate_lookups()
 
         if isinstance(output, list) and len(output) == 1:
             output = output[0]
@@ -250,13 +496,17 @@ class Schema(object):
 
         return output
 
-    def sync(self, objs, keys=None, workers=10):
+    def sync(self, objs, keys=None, workers=10, diff=False, delete=False, scope=None):
         """
 
         :param objs: A object or list of objects to insert into the schema
         :param keys:  Specifies a filter key list from object.
         :param workers: Optional. If set to greater than 1, creates objects in parallel requests. If is 1 is serial.
             default is 10.
+        :param diff: Optional. If set to true, use sync_diff: existing objects are fetched in bulk and only changes
+            are written. Returns a summary instead of objects.
+        :param delete: Optional. Only with diff, see sync_diff.
+        :param scope: Optional. Only with diff, see sync_diff.
         :return:
         """
 
@@ -266,11 +516,19 @@ class Schema(object):
         if not (isinstance(objs, list)):
            objs = [objs]
 
+        if diff:
+            return self.sync_diff(objs, keys, workers, delete, scope)
+        self.check_upsert()
+
+        resolved = self.resolve_lookups(objs) if self.itop.data_model else None
+
         def step(obj):
             query = dict([(field, obj[field]) for field in obj if field in keys])
+            if resolved is not None:
+                obj = self.lookup(obj, resolved)
             return self.update(query, obj, upsert=True, multi=False)
 
-        results = tmap(step, objs, workers=workers)
+        results = self.parallel(step, objs, workers=workers)
         output = [item for result in results if result for item in result]
 
         if isinstance(output, list) and len(output) == 1:
@@ -281,7 +539,246 @@ class Schema(object):
 
         return output
 
-    def lookup(self, obj):
+    def sync_diff(self, objs, keys=None, workers=10, delete=False, scope=None, chunk_size=None):
+        """
+        Synchronize objects comparing them with the existing ones, so only what changed is written:
+        objects with new keys are created, existing objects are updated with the changed fields only and
+        unchanged objects are not written at all. Objects are cleaned as in insert: '_' prefixes are removed and
+        empty fields are ignored, except keys.
+
+        :param objs: A object or list of objects to synchronize into the schema.
+        :param keys: Specifies a filter key list from object. default is ['name'].
+        :param workers: Optional. Parallel requests for writes. default is 10.
+        :param delete: Optional. If set to true, removes existing objects, matching scope, whose keys are not in objs.
+        :param scope: Optional. Selection filter of existing objects considered by delete. default is all objects.
+        :param chunk_size: Optional. Maximum keys per query when fetching existing objects.
+            default is itop lookup_chunk_size.
+        :return: dict with created, updated, unchanged and deleted counts, and the written objects.
+        """
+        keys = keys if keys else ['name']
+        objs = objs if isinstance(objs, list) else [objs]
+        chunk_size = chunk_size or getattr(self.itop, 'lookup_chunk_size', 500)
+        text = lambda value: '' if value is None else str(value)
+        normalize = lambda value: text(value).strip().lower()
+
+        # last object wins when the same key appears more than once
+        batch = {}
+        for obj in objs:
+            obj = {**self.clean(obj), **{key: obj[key] for key in keys if key in obj}}
+            missing = [key for key in keys if key not in obj]
+            if missing:
+                raise ValueError('Sync key Error. Object %s has no key field(s) %s' % (obj, missing))
+            batch_key = tuple(normalize(obj[key]) for key in keys)
+            batch[batch_key] = {**batch.get(batch_key, {}), **obj}
+
+        if self.itop.data_model:
+            resolved = self.resolve_lookups(list(batch.values()))
+            desired = {batch_key: self.lookup(dict(obj), resolved) for batch_key, obj in batch.items()}
+        else:
+            desired = dict(batch)
+
+        fields = set(keys)
+        for obj in desired.values():
+            fields.update(obj)
+        output_fields = self.to_output_fields(sorted(fields))
+
+        existing = {}
+
+        def index(obj):
+            existing_key = tuple(normalize(obj.get(key)) for key in keys)
+            if existing_key in existing:
+                raise ValueError('Sync key Error. Several items found in schema "%s" for keys %s' %
+                                 (self.name, dict(zip(keys, existing_key))))
+            existing[existing_key] = obj
+
+        batch_keys = list(batch)
+        for i in range(0, len(batch_keys), chunk_size):
+            chunk = batch_keys[i:i + chunk_size]
+            query = {key: {'$in': sorted(set(batch[batch_key][key] for batch_key in chunk), key=str)} for key in keys}
+            data = {
+                'operation': 'core/get',
+                'comment': 'Get ' + self.name,
+                'class': self.name,
+                'key': self.to_oql(query),
+                'output_fields': output_fields
+            }
+            chunk_keys = set(chunk)
+            for obj in self.itop.request(data):
+                # IN on each key is a superset of the key tuples
+                if tuple(normalize(obj.get(key)) for key in keys) in chunk_keys:
+                    index(obj)
+
+        def changed(old, new):
+            if isinstance(new, list):
+                old = old if isinstance(old, list) else []
+                return len(old) != len(new) or any(
+                    not any(all(text(o.get(k)) == text(v) for k, v in child.items()) for o in old)
+                    for child in new)
+            return text(old) != text(new)
+
+        creates, updates, unchanged = [], [], 0
+        for batch_key, obj in desired.items():
+            current = existing.get(batch_key)
+            if current is None:
+                creates.append(obj)
+                continue
+            fields = {k: v for k, v in obj.items() if k != 'id' and changed(current.get(k), v)}
+            if fields:
+                updates.append((current['id'], fields))
+            else:
+                unchanged += 1
+
+        deletes = []
+        if delete:
+            for obj in self.iter_find(scope, keys + ['id'], page_size=chunk_size * 10):
+                if tuple(normalize(obj.get(key)) for key in keys) not in desired:
+                    deletes.append(obj['id'])
+
+        datas = [
+            {
+                'operation': 'core/create',
+                'comment': 'Create' + self.name,
+                'class': self.name,
+                'output_fields': "*",
+                'fields': obj
+            } for obj in creates
+        ] + [
+            {
+                'operation': 'core/update',
+                'comment': 'Update ' + self.name,
+                'class': self.name,
+                'output_fields': "*",
+                'fields': fields,
+                'key': key
+            } for key, fields in updates
+        ] + [
+            {
+                'operation': 'core/delete',
+                'comment': 'Delete ' + self.name,
+                'class': self.name,
+                'key': self.to_oql({'id': {'$in': deletes[i:i + chunk_size]}})
+            } for i in range(0, len(deletes), chunk_size)
+        ]
+
+        try:
+            output = self.parallel(self.itop.request, datas, workers=workers)
+        finally:
+            if datas:
+                self.invalidate_lookups()
+
+        return {
+            'created': len(creates),
+            'updated': len(updates),
+            'unchanged': unchanged,
+            'deleted': len(deletes),
+            'objects': [item for result in output[:len(creates) + len(updates)] for item in result]
+        }
+
+    def import_file(self, filename, mode='insert', keys=None, format=None, chunk_size=1000, workers=10,
+                    checkpoint=None, delimiter=',', encoding='utf-8'):
+        """
+        Insert or sync the rows of a CSV, JSON lines or Parquet file, chunk by chunk: the next chunk is read in
+        background while the current one is written, so memory does not grow with the file size. Fields are cleaned
+        as in insert, lookups of a chunk are resolved in batch and writes run in workers parallel requests.
+        In CSV files, linked sets are read from json lists.
+
+        :param filename: .csv, .jsonl or .parquet file (parquet requires pyarrow)
+        :param mode: Optional. 'insert' or 'sync' (sync_diff by keys, without delete). default is 'insert'.
+        :param keys: Optional. Keys of sync. default is ['name'].
+        :param format: Optional. 'csv', 'jsonl' or 'parquet'. default is guessed from the extension.
+        :param chunk_size: Optional. Rows read and written at a time. default is 1000.
+        :param workers: Optional. Parallel requests. default is 10.
+        :param checkpoint: Optional. json file where the offset of written rows is saved after each chunk. A rerun
+            resumes after this offset, and the file is removed when the import completes. Rows of the failed chunk
+            are written again, unless the Itop journal recorded them.
+        :return: dict with rows read, skipped (before the checkpoint) and written, plus the sync counts
+        """
+        from .bulk import Checkpoint, prefetch, read_chunks
+
+        if mode not in ('insert', 'sync'):
+            raise ValueError("Mode must be 'insert' or 'sync'")
+        keys = keys if keys else ['name']
+        saved = Checkpoint(checkpoint, filename) if checkpoint else None
+        offset = saved.offset if saved else 0
+
+        summary = {'rows': 0, 'skipped': 0, 'written': 0}
+        if mode == 'sync':
+            summary.update(created=0, updated=0, unchanged=0)
+        for chunk in prefetch(read_chunks(filename, format, chunk_size, delimiter, encoding)):
+            position = summary['rows']
+            summary['rows'] += len(chunk)
+            if summary['rows'] <= offset:
+                summary['skipped'] += len(chunk)
+                continue
+            if position < offset:
+                summary['skipped'] += offset - position
+                chunk = chunk[offset - position:]
+
+            objs = [obj for obj in (self.clean(row) for row in chunk) if obj]
+            if mode == 'insert':
+                self.insert(objs, workers=workers)
+            else:
+                result = self.sync_diff(objs, keys, workers=workers)
+                for count in ('created', 'updated', 'unchanged'):
+                    summary[count] += result[count]
+            summary['written'] += len(chunk)
+            if saved:
+                saved.save(summary['rows'])
+
+        if saved:
+            saved.remove()
+        return summary
+
+    def export_file(self, filename, query=None, projection=None, format=None, page_size=1000, stream=False,
+                    delimiter=',', encoding='utf-8'):
+        """
+        Write the objects that match the query to a CSV, JSON lines or Parquet file, page by page.
+        Linked sets are written as json lists in CSV and Parquet files.
+        :param filename: .csv, .jsonl or .parquet file (parquet requires pyarrow)
+        :param query: Optional. Specifies selection filter.
+        :param projection: Optional. Columns written, default is the fields of the first object.
+        :param format: Optional. 'csv', 'jsonl' or 'parquet'. default is guessed from the extension.
+        :param page_size: Optional. Objects requested per page. default is 1000.
+        :param stream: Optional. If set to true, responses are parsed incrementally, see iter_find.
+        :return: number of objects written
+        """
+        from .bulk import write_rows
+
+        objs = self.iter_find(query, projection, page_size=page_size, stream=stream)
+        return write_rows(filename, objs, projection, format, page_size or 1000, delimiter, encoding)
+
+    def map_results(self, fn, args, workers=10):
+        """
+        Apply fn to every arg with the itop scheduler, collecting each result or error.
+        :return: list of Result
+        """
+        scheduler = getattr(self.itop, 'scheduler', None)
+        if scheduler is not None:
+            return scheduler.map(fn, args, workers)
+
+        def step(arg):
+            try:
+                return Result(fn(arg), attempts=1)
+            except Exception as e:
+                return Result(error=e, attempts=1)
+        return tmap(step, args, workers=workers)
+
+    def parallel(self, fn, args, workers=10):
+        """
+        Apply fn to every arg with the itop scheduler. Failures do not stop the batch, when all items are done
+        a BatchError with every result is raised. A single item raises its own error.
+        :return: list of results
+        """
+        results = self.map_results(fn, args, workers)
+        errors = [(i, result.error) for i, result in enumerate(results) if result.error is not None]
+        if errors:
+            if len(results) == 1:
+                raise errors[0][1]
+            raise BatchError(results, errors)
+        return [result.value for result in results]
+
+    @timed('lookup')
+    def lookup(self, obj, resolved=None):
         """
 
         Quando existir um campo externo no corpo do objeto, convertê-lo para uma chave externa.
@@ -289,6 +786,7 @@ class Schema(object):
         somente com chave externa
 
         :param obj:
+        :param resolved: Optional. Resolutions returned by resolve_lookups.
         :return:
         """
 
@@ -298,7 +796,7 @@ class Schema(object):
             old_value = obj[field]
             external_key, lookup_class, lookup_field = schema_lookups[field]
             if old_value:
-                value = self.itop.schema(lookup_class).find({lookup_field: old_value}, ['id'])
+                value = self.resolve_lookup(lookup_class, lookup_field, old_value, resolved)
                 if value == [] or value == '':
                     raise ValueError(
                         'Lookup field Error. ' +
@@ -327,7 +825,7 @@ class Schema(object):
                     old_value = child_obj[field]
                     external_key, lookup_class, lookup_field = linked_sets_lookups[field]
                     if old_value:
-                        value = self.itop.schema(lookup_class).find({lookup_field: old_value}, ['id'])
+                        value = self.resolve_lookup(lookup_class, lookup_field, old_value, resolved)
                         if value == [] or value == '':
                             raise ValueError(
                                 'Lookup field Error. ' +
@@ -340,6 +838,108 @@ class Schema(object):
 
         return obj
 
+    @timed('resolve_lookup')
+    def resolve_lookup(self, lookup_class, lookup_field, value, resolved=None):
+        """
+        Find the id of the object of lookup_class which lookup_field is value, using the itop lookup cache.
+        :param resolved: Optional. Resolutions returned by resolve_lookups.
+        :return: id, list of objects when ambiguous or [] when not found
+        """
+        cache = getattr(self.itop, 'lookup_cache', None)
+        key = (lookup_class, lookup_field, value)
+        if resolved and key in resolved:
+            return resolved[key]
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+        result = self.itop.schema(lookup_class).find({lookup_field: value}, ['id'])
+
+        if cache is not None:
+            cache.set(key, result)
+        return result
+
+    @timed('resolve_lookups')
+    def resolve_lookups(self, objs, chunk_size=None):
+        """
+        Resolve every distinct lookup value of a batch with one IN query per lookup class and field,
+        instead of one find for each field of each object.
+        :param objs: list of objects, with external fields and linked sets as accepted by lookup.
+        :param chunk_size: Optional. Maximum values per query. default is itop lookup_chunk_size.
+        :return: dict index by (lookup_class, lookup_field, value) = id, list of objects when ambiguous or [] when
+            not found. Also stored in the itop lookup cache.
+        """
+        data_model = self.itop.data_model
+        chunk_size = chunk_size or getattr(self.itop, 'lookup_chunk_size', 500)
+        cache = getattr(self.itop, 'lookup_cache', None)
+
+        pending = {}
+
+        def collect(schema, obj):
+            schema_lookups = data_model.lookupExternalField(schema)
+            for field in obj:
+                if field in schema_lookups and obj[field] and not isinstance(obj[field], (list, dict)):
+                    _, lookup_class, lookup_field = schema_lookups[field]
+                    pending.setdefault((lookup_class, lookup_field), set()).add(obj[field])
+
+        schema_linked_sets = data_model.lookupLinkedSet(self.name)
+        for obj in objs:
+            collect(self.name, obj)
+            for field in obj:
+                if field in schema_linked_sets and isinstance(obj[field], list):
+                    linked_class = schema_linked_sets[field][0]
+                    for child_obj in obj[field]:
+                        collect(linked_class, child_obj)
+
+        resolved = {}
+        for (lookup_class, lookup_field), values in pending.items():
+            if cache is not None:
+                for value in list(values):
+                    cached = cache.get((lookup_class, lookup_field, value))
+                    if cached is not None:
+                        resolved[(lookup_class, lookup_field, value)] = cached
+                        values.discard(value)
+
+            values = sorted(values, key=str)
+            for i in range(0, len(values), chunk_size):
+                chunk = values[i:i + chunk_size]
+                data = {
+                    'operation': 'core/get',
+                    'comment': 'Get ' + lookup_class,
+                    'class': lookup_class,
+                    'key': "SELECT %s WHERE %s" % (lookup_class, oql.compile({lookup_field: {'$in': chunk}})),
+                    'output_fields': lookup_field
+                }
+                found = {}
+                for obj in self.itop.request(data):
+                    found.setdefault(str(obj.get(lookup_field)).strip().lower(), []).append({'id': obj['id']})
+
+                for value in chunk:
+                    ids = found.get(str(value).strip().lower(), [])
+                    result = ids[0]['id'] if len(ids) == 1 else ids
+                    resolved[(lookup_class, lookup_field, value)] = result
+                    if cache is not None:
+                        cache.set((lookup_class, lookup_field, value), result)
+
+        return resolved
+
+    def check_upsert(self):
+        """
+        Upsert creates the object when the update finds nothing, which is only known after a batch is flushed.
+        """
+        if self.itop.active_batch() is not None:
+            raise ValueError('Upsert and sync can not run inside itop.batch, since queued updates do not tell if the '
+                             'object exists. Use sync(objs, keys, diff=True), which fetches existing objects first.')
+
+    def invalidate_lookups(self):
+        """
+        Drop cached lookup resolutions of this schema, its parents and subclasses after it is written by this client.
+        """
+        cache = getattr(self.itop, 'lookup_cache', None)
+        if cache is not None:
+            cache.invalidate_schema(self.itop.related_schemas(self.name))
+
     def apply_stimulus(self, query, stimulus_data, stimulus="env_assign"):
         """
 
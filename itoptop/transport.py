@@ -0,0 +1,258 @@
+import gzip
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def connect_failed(error):
+    """
+    Tell if a request failed before reaching the server: connect timeouts and refused or unresolved connections.
+    Other errors (read timeouts, connections closed while waiting for the response) may come after iTop processed it.
+    """
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+    pending, seen = [error], set()
+    while pending:
+        error = pending.pop()
+        if id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, (requests.exceptions.ConnectTimeout, ConnectTimeoutError, NewConnectionError)):
+            return True
+        # requests wraps urllib3 errors in args, urllib3 MaxRetryError keeps the cause as reason
+        causes = list(error.args) + [getattr(error, 'reason', None), error.__cause__, error.__context__]
+        pending += [cause for cause in causes if isinstance(cause, BaseException)]
+    return False
+
+
+class Transport(object):
+    def __init__(self, url, pool_size=10, compress=False, timeout=None):
+        """
+        Pooled keep-alive HTTP transport to a single iTop rest.php endpoint.
+        :param url: iTop rest.php endpoint
+        :param pool_size: Maximum number of connections kept open. Should match the number of workers.
+        :param compress: Optional. If set to true, send the form body gzip encoded (requires server support).
+        :param timeout: Optional. Request timeout in seconds.
+        """
+        self.url = url
+        self.pool_size = pool_size
+        self.compress = compress
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.session.headers.update({'Connection': 'keep-alive', 'Accept-Encoding': 'gzip, deflate'})
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def post(self, data, **kwargs):
+        """
+        Post form data to the endpoint reusing pooled connections.
+        :param data: dict of form fields
+        :return: requests.Response
+        """
+        headers = {}
+        if self.compress:
+            data = gzip.compress(urlencode(data).encode('utf-8'))
+            headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'}
+        with self._lock:
+            self._requests += 1
+        return self.session.post(self.url, data=data, headers=headers, timeout=self.timeout, **kwargs)
+
+    def stats(self):
+        """
+        Connection reuse statistics, summed over every pool opened by this transport.
+        :return: dict with requests, connections and reused counts
+        """
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+        return {
+            'requests': self._requests,
+            'connections': connections,
+            'reused': max(self._requests - connections, 0),
+            'pool_size': self.pool_size
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class Endpoint(object):
+    __slots__ = ('transport', 'weight', 'current', 'outstanding', 'failures', 'ejected_until', 'probing')
+
+    def __init__(self, transport, weight=1):
+        self.transport = transport
+        self.weight = weight
+        self.current = 0  # smooth weighted round-robin counter
+        self.outstanding = 0
+        self.failures = 0  # consecutive, the ejection time doubles with each one
+        self.ejected_until = None
+        self.probing = False
+
+
+class Balancer(object):
+    def __init__(self, urls, pool_size=10, compress=False, timeout=None, weights=None, routing='least_outstanding',
+                 eject_seconds=10, max_eject_seconds=300, probe=None):
+        """
+        Transport spreading requests over several iTop rest.php endpoints, each with its own connection pool.
+        An endpoint returning a connection error or HTTP 5xx is ejected for eject_seconds, doubled on each
+        consecutive failure, then probed and taken back when the probe succeeds. Requests that could not connect
+        are sent again to the next endpoint, other errors are raised since iTop may have processed the request.
+        When every endpoint is ejected, the one back soonest is used.
+        :param urls: list of iTop rest.php endpoints
+        :param pool_size: Maximum number of connections kept open to each endpoint.
+        :param compress: Optional. If set to true, send the form body gzip encoded (requires server support).
+        :param timeout: Optional. Request timeout in seconds.
+        :param weights: Optional. list of relative capacities of the endpoints. default is 1 for each.
+        :param routing: Optional. 'least_outstanding' sends to the endpoint with the fewest requests in flight per
+            weight, 'round_robin' alternates endpoints in proportion to their weight. default is 'least_outstanding'.
+        :param eject_seconds: Optional. Seconds an endpoint is ejected after its first failure. default is 10.
+        :param max_eject_seconds: Optional. Maximum seconds of an ejection. default is 300.
+        :param probe: Optional. Form data posted to an ejected endpoint when its ejection ends, in background. It is
+            taken back on HTTP 200 with an iTop code 0. Without probe, it is taken back directly.
+        """
+        if isinstance(urls, str):
+            urls = [urls]
+        weights = weights or [1] * len(urls)
+        if not urls or len(weights) != len(urls):
+            raise ValueError('Expected one weight for each of the %d urls' % len(urls))
+        if routing not in ('least_outstanding', 'round_robin'):
+            raise ValueError("Routing must be 'least_outstanding' or 'round_robin'")
+        self.url = urls[0]
+        self.urls = list(urls)
+        self.pool_size = pool_size
+        self.routing = routing
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.probe = probe
+        self.endpoints = [Endpoint(Transport(url, pool_size, compress, timeout), weight)
+                          for url, weight in zip(urls, weights)]
+        self._lock = threading.Lock()
+        self._next = 0  # first endpoint tried on ties, rotated
+
+    def healthy(self, endpoint, now):
+        if endpoint.ejected_until is None:
+            return True
+        if now >= endpoint.ejected_until and not endpoint.probing:
+            if self.probe is None:
+                endpoint.ejected_until = None
+                return True
+            endpoint.probing = True
+            threading.Thread(target=self.check, args=(endpoint,), name='itoptop-probe', daemon=True).start()
+        return False
+
+    def pick(self, exclude=()):
+        """
+        Endpoint for the next request, counted as outstanding until release.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in exclude and self.healthy(endpoint, now)]
+            if not candidates:
+                candidates = sorted((endpoint for endpoint in self.endpoints if endpoint not in exclude),
+                                    key=lambda endpoint: endpoint.ejected_until)[:1]
+                if not candidates:
+                    return None
+
+            if self.routing == 'round_robin':
+                total = 0
+                for endpoint in candidates:
+                    endpoint.current += endpoint.weight
+                    total += endpoint.weight
+                endpoint = max(candidates, key=lambda endpoint: endpoint.current)
+                endpoint.current -= total
+            else:
+                self._next = (self._next + 1) % len(candidates)
+                candidates = candidates[self._next:] + candidates[:self._next]
+                endpoint = min(candidates, key=lambda endpoint: endpoint.outstanding / endpoint.weight)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint, failed):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed and endpoint.ejected_until is None:
+                # concurrent failures of an ejected endpoint count once
+                self.eject(endpoint)
+            elif endpoint.ejected_until is None:
+                endpoint.failures = 0
+
+    def eject(self, endpoint):
+        seconds = min(self.eject_seconds * 2 ** endpoint.failures, self.max_eject_seconds)
+        endpoint.failures += 1
+        endpoint.ejected_until = time.monotonic() + seconds
+
+    def check(self, endpoint):
+        """
+        Probe an ejected endpoint, taken back when it answers.
+        """
+        try:
+            response = endpoint.transport.post(self.probe)
+            ok = response.status_code == 200 and response.json().get('code') == 0
+        except (requests.exceptions.RequestException, ValueError):
+            ok = False
+        with self._lock:
+            endpoint.probing = False
+            if ok:
+                endpoint.ejected_until = None
+                endpoint.failures = 0
+            else:
+                self.eject(endpoint)
+
+    def post(self, data, **kwargs):
+        """
+        Post form data to an endpoint chosen by the routing.
+        :param data: dict of form fields
+        :return: requests.Response
+        """
+        tried = []
+        endpoint = self.pick()
+        while True:
+            tried.append(endpoint)
+            try:
+                response = endpoint.transport.post(data, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                self.release(endpoint, True)
+                # only when the request did not reach iTop, else it may have been applied already
+                endpoint = self.pick(tried) if connect_failed(e) else None
+                if endpoint is None:
+                    raise
+                continue
+            except Exception:
+                self.release(endpoint, False)
+                raise
+            self.release(endpoint, response.status_code >= 500)
+            return response
+
+    def stats(self):
+        """
+        Connection reuse statistics summed over the endpoints, and the state of each one.
+        :return: dict with requests, connections and reused counts, and endpoints
+        """
+        now = time.monotonic()
+        endpoints = []
+        for endpoint in self.endpoints:
+            stats = endpoint.transport.stats()
+            stats.update(url=endpoint.transport.url, weight=endpoint.weight, outstanding=endpoint.outstanding,
+                         healthy=endpoint.ejected_until is None,
+                         ejected_seconds=max(endpoint.ejected_until - now, 0.0) if endpoint.ejected_until else 0.0)
+            endpoints.append(stats)
+        return {
+            'requests': sum(stats['requests'] for stats in endpoints),
+            'connections': sum(stats['connections'] for stats in endpoints),
+            'reused': sum(stats['reused'] for stats in endpoints),
+            'pool_size': self.pool_size * len(self.endpoints),
+            'endpoints': endpoints
+        }
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.transport.close()
@@ -23,5 +23,10 @@ setup(
     install_requires=[
         "requests",
         "lxml"
-    ]
+    ],
+    extras_require={
+        "async": ["aiohttp"],
+        "fast": ["orjson"],
+        "parquet": ["pyarrow"]
+    }
 )